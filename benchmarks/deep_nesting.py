@@ -0,0 +1,71 @@
+"""Benchmark: solve a deeply-nested list-of-lists layout problem.
+
+The block tree mirrors tests/test_example.py: every list may be laid out
+either on one line or as an indented block, so the solver sees a ChoiceBlock
+at every level of nesting.
+
+Usage: python benchmarks/deep_nesting.py [depth] [width]
+"""
+
+import sys
+import time
+import tracemalloc
+from typing import Any, List
+
+from format_blocks import (
+    ChoiceBlock,
+    LayoutBlock,
+    LineBlock,
+    Options,
+    StackBlock,
+    TextBlock,
+)
+
+
+def make_data(depth: int, width: int) -> List[Any]:
+    data: List[Any] = list(range(width))
+    for level in range(depth):
+        data = [level * 1000 + i for i in range(width)] + [data]
+    return data
+
+
+def format_list(data: Any, current: LayoutBlock) -> LayoutBlock:
+    if not isinstance(data, list):
+        return LineBlock([current, TextBlock(repr(data))])
+    block = StackBlock(
+        [LineBlock([current, TextBlock("[")])]
+        + [
+            LineBlock([TextBlock("  "), format_list(x, TextBlock("")), TextBlock(",")])
+            for x in data
+        ]
+        + [TextBlock("]")]
+    )
+    line: LayoutBlock = LineBlock([current, TextBlock("[")])
+    for i, x in enumerate(data):
+        line = format_list(x, line)
+        if i < len(data) - 1:
+            line = LineBlock([line, TextBlock(", ")])
+    line = LineBlock([line, TextBlock("]")])
+    return ChoiceBlock([block, line])
+
+
+def main(depth: int = 7, width: int = 6) -> None:
+    data = make_data(depth, width)
+    options = Options(margin_0=10, margin_1=60)
+    # Timing and memory are measured on separate trees, since tracing
+    # allocations slows the solver down considerably.
+    start = time.perf_counter()
+    text = format_list(data, TextBlock("")).Render(options)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    format_list(data, TextBlock("")).Render(options)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        "depth=%d width=%d lines=%d time=%.3fs peak=%.1fMiB"
+        % (depth, width, text.count("\n") + 1, elapsed, peak / 2 ** 20)
+    )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,87 @@
+"""Benchmark: lay out a tree built from the joining blocks of format_blocks.extras.
+
+The document is a stack of statements, each a call (its name joined to the
+parenthesis by _ConditionalJoinedLineBlock) whose arguments are expressions
+joined with operators (JoinedLineBlock), nested a few calls deep. The arguments
+are wrapped (_WrapIfLongBlock) or one per line (_JoinedStackBlock), on the line
+of the call or indented below it, so the joining blocks are laid out for
+several continuations, and the layouts memoised by the blocks they lower
+themselves to are reused. The solve time and the layout cache hits and misses
+are reported.
+
+Usage: python benchmarks/joins.py [statements] [depth]
+"""
+
+import sys
+import time
+
+from format_blocks import (
+    ChoiceBlock,
+    JoinedLineBlock,
+    LayoutBlock,
+    Options,
+    StackBlock,
+    TextBlock,
+    cache_stats,
+)
+from format_blocks.extras import (
+    _ConditionalJoinedLineBlock,
+    _JoinedStackBlock,
+    _WrapIfLongBlock,
+    optionally_indented,
+)
+
+
+def make_call(name: str, depth: int, width: int) -> LayoutBlock:
+    args = []
+    for i in range(width):
+        if depth > 0 and i == width - 1:
+            args.append(make_call("%s_%d" % (name, i), depth - 1, width))
+        else:
+            args.append(
+                JoinedLineBlock(
+                    [TextBlock("%s_a%d" % (name, i)), TextBlock("*"), TextBlock("2")]
+                )
+            )
+    head = _ConditionalJoinedLineBlock([TextBlock(name), TextBlock("(")])
+    # The arguments are either wrapped, or one per line, and either way may be
+    # on the line of the call or indented below it (so the same blocks are laid
+    # out with several continuations).
+    return optionally_indented(
+        head,
+        ChoiceBlock(
+            [
+                _WrapIfLongBlock(args, sep=", ", wrap_len=3),
+                _JoinedStackBlock(args, joiner=TextBlock(",")),
+            ]
+        ),
+        TextBlock(")"),
+    )
+
+
+def make_document(statements: int, depth: int) -> LayoutBlock:
+    return StackBlock(make_call("f%d" % i, depth, 4) for i in range(statements))
+
+
+def main(statements: int = 200, depth: int = 3) -> None:
+    options = Options(margin_0=10, margin_1=60)
+    block = make_document(statements, depth)
+    cache_stats.Reset()
+    start = time.perf_counter()
+    text = block.Render(options)
+    elapsed = time.perf_counter() - start
+    print(
+        "statements=%d depth=%d lines=%d time=%.3fs hits=%d misses=%d"
+        % (
+            statements,
+            depth,
+            text.count("\n") + 1,
+            elapsed,
+            cache_stats.hits,
+            cache_stats.misses,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
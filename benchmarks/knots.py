@@ -0,0 +1,100 @@
+"""Benchmark: bound the solver's cost by capping the knots of Solutions.
+
+The document is a stack of lines of calls, each of whose arguments may be laid
+out on any of 1 to k lines (narrower, but with more line breaks), so the
+Solutions of the calls, and of the lines holding several of them, have many
+knots. It is solved exactly, then with Options.max_knots (or knot_tolerance),
+and for each setting the solve time, the number and knots of the distinct
+Solutions memoised, and the gap between the approximate and the exact cost
+of the whole document, at each margin from 0 to margin_1, are reported.
+
+Usage: python benchmarks/knots.py [calls] [k]
+"""
+
+import dataclasses
+import sys
+import time
+from typing import List
+
+from suite import count_solutions
+
+from format_blocks import (
+    ChoiceBlock,
+    LayoutBlock,
+    LineBlock,
+    Options,
+    StackBlock,
+    TextBlock,
+)
+
+
+def staircase(words: List[str], k: int) -> LayoutBlock:
+    alternatives = []
+    for lines in range(1, k + 1):
+        per_line = -(-len(words) // lines)
+        alternatives.append(
+            StackBlock(
+                LineBlock([TextBlock(word + " ") for word in words[i : i + per_line]])
+                for i in range(0, len(words), per_line)
+            )
+        )
+    return ChoiceBlock(alternatives)
+
+
+def make_document(calls: int, k: int) -> LayoutBlock:
+    blocks = [
+        LineBlock(
+            [
+                TextBlock("f%d(" % i),
+                staircase(["w%d_%d" % (i, j) * (1 + j % 3) for j in range(12)], k),
+                TextBlock(")"),
+            ]
+        )
+        for i in range(calls)
+    ]
+    return StackBlock(LineBlock(blocks[i : i + 4]) for i in range(0, calls, 4))
+
+
+SETTINGS = [
+    {},
+    {"knot_tolerance": 0.5},
+    {"max_knots": 16},
+    {"max_knots": 8},
+    {"max_knots": 4},
+]
+
+
+def main(calls: int = 40, k: int = 8) -> None:
+    base = Options(margin_0=20, margin_1=60)
+    exact = None
+    for setting in SETTINGS:
+        options = dataclasses.replace(base, **setting)
+        block = make_document(calls, k)
+        start = time.perf_counter()
+        soln = block.OptLayout(None, options)
+        elapsed = time.perf_counter() - start
+        solutions, knots = count_solutions(block)
+        costs = []
+        for m in range(options.margin_1 + 1):
+            soln.MoveToMargin(m)
+            costs.append(soln.CurValueAt(m))
+        if exact is None:
+            exact = costs
+        gaps = [abs(c - e) / e if e else abs(c) for c, e in zip(costs, exact)]
+        print(
+            "%-22s solve=%.3fs solutions=%d knots=%d root knots=%d "
+            "cost gap: max %.2f%% mean %.2f%%"
+            % (
+                ", ".join("%s=%s" % item for item in setting.items()) or "exact",
+                elapsed,
+                solutions,
+                knots,
+                len(soln.knots),
+                100 * max(gaps),
+                100 * sum(gaps) / len(gaps),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
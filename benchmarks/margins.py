@@ -0,0 +1,40 @@
+"""Benchmark: lay out blocks only for the margins at which they may start.
+
+The document is that of benchmarks/deep_nesting.py, whose inner lists may only
+start far from the margin. It is rendered with and without
+Options.restrict_margins, and for each the time, and the number and knots of
+the distinct Solutions memoised, are reported (the text is the same).
+
+Usage: python benchmarks/margins.py [depth] [width]
+"""
+
+import dataclasses
+import sys
+import time
+
+from deep_nesting import format_list, make_data
+from suite import count_solutions
+
+from format_blocks import Options, TextBlock
+
+
+def main(depth: int = 7, width: int = 6) -> None:
+    data = make_data(depth, width)
+    base = Options(margin_0=10, margin_1=60)
+    texts = []
+    for restrict_margins in (False, True):
+        options = dataclasses.replace(base, restrict_margins=restrict_margins)
+        block = format_list(data, TextBlock(""))
+        start = time.perf_counter()
+        texts.append(block.Render(options))
+        elapsed = time.perf_counter() - start
+        solutions, knots = count_solutions(block)
+        print(
+            "restrict_margins=%-5s time=%.3fs solutions=%d knots=%d"
+            % (restrict_margins, elapsed, solutions, knots)
+        )
+    assert texts[0] == texts[1]
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
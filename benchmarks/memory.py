@@ -0,0 +1,76 @@
+"""Benchmark: the memory taken by the blocks of a large tree.
+
+The document is a stack of statements, each a line of ten tokens (TextBlocks),
+with a choice of wrapping every tenth statement. The memory allocated for a
+tree of a million tokens is measured once it is built, and that for a smaller
+tree (since tracing allocations slows the solver down) once it has been laid
+out, and reported per block, along with the time taken to lay it out.
+
+Usage: python benchmarks/memory.py [tokens] [laid_out_tokens]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from format_blocks import (
+    ChoiceBlock,
+    LayoutBlock,
+    LineBlock,
+    Options,
+    StackBlock,
+    TextBlock,
+    WrapBlock,
+)
+
+
+def make_statement(i: int) -> LayoutBlock:
+    tokens = [TextBlock("t%d_%d" % (i, j)) for j in range(10)]
+    if i % 10:
+        return LineBlock(tokens)
+    return ChoiceBlock([LineBlock(tokens), WrapBlock(tokens)])
+
+
+def count_blocks(block: LayoutBlock) -> int:
+    seen = set()
+    stack = [block]
+    while stack:
+        node = stack.pop()
+        if id(node) not in seen:
+            seen.add(id(node))
+            stack.extend(node.Children())
+    return len(seen)
+
+
+def measure(tokens: int, lay_out: bool) -> None:
+    options = Options(margin_0=10, margin_1=60)
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    block = StackBlock(make_statement(i) for i in range(tokens // 10))
+    label = "built"
+    elapsed = 0.0
+    if lay_out:
+        # The text is generated and dropped line by line, so it isn't counted.
+        label = "laid out"
+        start = time.perf_counter()
+        for _ in block.IterLines(options):
+            pass
+        elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    blocks = count_blocks(block)
+    print(
+        "%-8s tokens=%d blocks=%d memory=%.1fMiB (%.0fB/block) time=%.1fs"
+        % (label, tokens, blocks, size / 2 ** 20, size / blocks, elapsed)
+    )
+
+
+def main(tokens: int = 1000000, laid_out_tokens: int = 10000) -> None:
+    measure(tokens, lay_out=False)
+    measure(laid_out_tokens, lay_out=True)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
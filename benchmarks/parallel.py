@@ -0,0 +1,54 @@
+"""Benchmark: lay out a long top-level stack of statements in parallel.
+
+Each statement is a small nested list (as in deep_nesting.py), and the
+statements are independent of each other, so parallel.SolveInParallel may lay
+them out in separate processes. The layout is computed sequentially, then with
+1, 2, 4, ... worker processes up to the number of CPUs, and the speedup over
+the sequential time is reported. All layouts must render identically.
+
+Usage: python benchmarks/parallel.py [statements] [depth] [width]
+"""
+
+import os
+import sys
+import time
+
+from deep_nesting import format_list, make_data
+
+from format_blocks import LayoutBlock, LineBlock, Options, StackBlock, TextBlock
+from format_blocks.parallel import SolveInParallel
+
+
+def make_statements(statements: int, depth: int, width: int) -> LayoutBlock:
+    return StackBlock(
+        format_list(make_data(depth, width), TextBlock("x%d = " % i))
+        for i in range(statements)
+    )
+
+
+def main(statements: int = 2000, depth: int = 3, width: int = 4) -> None:
+    options = Options(margin_0=10, margin_1=60)
+    start = time.perf_counter()
+    expected = make_statements(statements, depth, width).Render(options)
+    sequential = time.perf_counter() - start
+    print("sequential  %.3fs" % sequential)
+    cpus = os.cpu_count() or 1
+    workers = 1
+    while True:
+        block = make_statements(statements, depth, width)
+        start = time.perf_counter()
+        SolveInParallel(block, options, workers=workers)
+        output = block.Render(options)
+        elapsed = time.perf_counter() - start
+        print(
+            "workers=%-3d %.3fs  speedup x%.2f"
+            % (workers, elapsed, sequential / elapsed)
+        )
+        assert output == expected
+        if workers >= cpus:
+            break
+        workers = min(workers * 2, cpus)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,70 @@
+"""Benchmark: render a solved layout with Console and BufferedConsole.
+
+Two documents are rendered: a StackBlock of many short statements, and a
+single LineBlock of many tokens (whose layout nests as deeply as the line is
+long). Each is rendered both to memory and to a file, and both consoles must
+produce identical output.
+
+Usage: python benchmarks/render.py [lines] [tokens]
+"""
+
+import io
+import sys
+import tempfile
+import time
+from typing import IO, Callable, List, Tuple, Type
+
+from format_blocks import LayoutBlock, LineBlock, Options, StackBlock, TextBlock
+from format_blocks.support import BufferedConsole, Console
+
+
+def make_statements(lines: int) -> LayoutBlock:
+    return StackBlock(
+        LineBlock(
+            [TextBlock("  " * (i % 4)), TextBlock("x%d" % i), TextBlock(" = f(a, b)")]
+        )
+        for i in range(lines)
+    )
+
+
+def make_long_line(tokens: int) -> LayoutBlock:
+    return LineBlock(TextBlock("t%d " % i) for i in range(tokens))
+
+
+def render(
+    block: LayoutBlock, console_class: Type[Console], stream: IO[str], label: str
+) -> str:
+    options = Options()
+    layout = block.OptLayout(None, options).layouts[0]
+    start = time.perf_counter()
+    try:
+        console_class(stream, options.margin_0, options.margin_1).PrintLayout(layout)
+    except RecursionError:
+        print("  %-15s %-6s RecursionError" % (console_class.__name__, label))
+        return ""
+    print(
+        "  %-15s %-6s %.3fs"
+        % (console_class.__name__, label, time.perf_counter() - start)
+    )
+    stream.seek(0)
+    return stream.read()
+
+
+def main(lines: int = 100000, tokens: int = 5000) -> None:
+    streams: List[Tuple[str, Callable[[], IO[str]]]] = [
+        ("memory", io.StringIO),
+        ("file", lambda: tempfile.TemporaryFile("w+")),
+    ]
+    for name, block in [
+        ("%d lines" % lines, make_statements(lines)),
+        ("%d-token line" % tokens, make_long_line(tokens)),
+    ]:
+        print(name)
+        for label, stream in streams:
+            expected = render(block, Console, stream(), label)
+            output = render(block, BufferedConsole, stream(), label)
+            assert not expected or output == expected
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
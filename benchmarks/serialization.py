@@ -0,0 +1,57 @@
+"""Benchmark: hand a block tree to another process, serialized or pickled.
+
+The document is that of benchmarks/memory.py. It is serialized with
+format_blocks.serialization and with pickle, and for each the size, and the
+times to dump it and load it back (from bytes, and from an mmap of a file), are
+reported.
+
+Usage: python benchmarks/serialization.py [tokens]
+"""
+
+import gc
+import mmap
+import pickle
+import sys
+import tempfile
+import time
+
+from memory import make_statement
+
+from format_blocks import Options, StackBlock
+from format_blocks.serialization import dump, load
+
+
+def main(tokens: int = 100000) -> None:
+    options = Options(margin_0=10, margin_1=60)
+    block = StackBlock(make_statement(i) for i in range(tokens // 10))
+    expected = block.Render(options)
+    for name, dumps, loads in [
+        ("pickle", pickle.dumps, pickle.loads),
+        ("serialization", dump, load),
+    ]:
+        start = time.perf_counter()
+        data = dumps(block)
+        dumped = time.perf_counter() - start
+        # Collecting first keeps full collections of the trees out of the times.
+        gc.collect()
+        start = time.perf_counter()
+        loaded = loads(data)
+        from_bytes = time.perf_counter() - start
+        del loaded
+        gc.collect()
+        with tempfile.TemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                start = time.perf_counter()
+                loaded = loads(m)
+                from_mmap = time.perf_counter() - start
+        assert loaded.Render(options) == expected
+        print(
+            "%-13s size=%.1fMiB dump=%.3fs load=%.3fs load(mmap)=%.3fs"
+            % (name, len(data) / 2 ** 20, dumped, from_bytes, from_mmap)
+        )
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
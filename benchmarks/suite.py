@@ -0,0 +1,202 @@
+"""Benchmark suite for the solver and the renderer, with regression tracking.
+
+Each case builds a block tree from the public blocks, then measures:
+  - solve_s: the time taken by OptLayout,
+  - render_s: the time taken by PrintOn, once the layout is solved,
+  - peak_mib: the peak memory allocated while solving and rendering (measured
+    on a fresh tree, since tracing allocations slows the solver down),
+  - solutions/knots: the number of distinct Solutions memoised by the tree's
+    blocks once solved, and their total number of knots,
+  - lines: the number of lines printed.
+Times are the best of --repeat runs, each on a fresh tree.
+
+The results are printed, and may be written as JSON with --output. Passing the
+JSON written for an earlier commit with --compare reports the ratio of each
+measure to it, and exits with status 1 if any grew by more than --threshold.
+
+Usage: python benchmarks/suite.py [--output FILE] [--compare FILE] [CASE ...]
+"""
+
+import argparse
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+from deep_nesting import format_list, make_data
+
+from format_blocks import (
+    LayoutBlock,
+    LineBlock,
+    Options,
+    StackBlock,
+    TextBlock,
+    VerbBlock,
+    WrapBlock,
+)
+
+Case = Tuple[Callable[[], LayoutBlock], Options]
+
+MEASURES = ("solve_s", "render_s", "peak_mib", "solutions", "knots", "lines")
+
+
+def nested_choices() -> LayoutBlock:
+    return format_list(make_data(7, 6), TextBlock(""))
+
+
+def long_wrap() -> LayoutBlock:
+    return LineBlock(
+        [
+            TextBlock("call("),
+            WrapBlock([TextBlock("arg%d" % i) for i in range(10000)], sep=", "),
+            TextBlock(")"),
+        ]
+    )
+
+
+def long_stack() -> LayoutBlock:
+    return StackBlock(
+        LineBlock([TextBlock("x%d" % i), TextBlock(" = "), TextBlock("f(a, b)")])
+        for i in range(20000)
+    )
+
+
+def verbatim() -> LayoutBlock:
+    return StackBlock(
+        VerbBlock(["# line %d of payload %d" % (j, i) for j in range(1000)])
+        for i in range(100)
+    )
+
+
+CASES: Dict[str, Case] = {
+    "nested_choices": (nested_choices, Options(margin_0=10, margin_1=60)),
+    "long_wrap": (long_wrap, Options(prune_wraps=True, restrict_margins=True)),
+    "long_stack": (long_stack, Options()),
+    "verbatim": (verbatim, Options()),
+}
+
+
+def count_solutions(block: LayoutBlock) -> Tuple[int, int]:
+    """ The number of distinct Solutions memoised in a tree, and their knots. """
+    seen_blocks: Set[int] = set()
+    seen_solutions: Set[int] = set()
+    knots = 0
+    stack = [block]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen_blocks:
+            continue
+        seen_blocks.add(id(node))
+        for soln in node.layout_cache.Solutions():
+            if id(soln) not in seen_solutions:
+                seen_solutions.add(id(soln))
+                knots += len(soln.knots)
+        stack.extend(node.Children())
+    return len(seen_solutions), knots
+
+
+def run_case(case: Case, repeat: int) -> Dict[str, Any]:
+    make, options = case
+    result: Dict[str, Any] = {}
+    for _ in range(repeat):
+        block = make()
+        start = time.perf_counter()
+        # At the margin the document is printed at (as by PrintOn).
+        block.OptLayout(None, options, margins=(0, 0))
+        solved = time.perf_counter()
+        output = io.StringIO()
+        block.PrintOn(options, output)
+        rendered = time.perf_counter()
+        result["solve_s"] = min(result.get("solve_s", solved - start), solved - start)
+        result["render_s"] = min(
+            result.get("render_s", rendered - solved), rendered - solved
+        )
+    result["solutions"], result["knots"] = count_solutions(block)
+    result["lines"] = output.getvalue().count("\n") + 1
+    block = make()
+    tracemalloc.start()
+    block.PrintOn(options, io.StringIO())
+    result["peak_mib"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return result
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float
+) -> List[str]:
+    """ Print the ratio of each measure to the baseline, returning regressions. """
+    regressions = []
+    for name, measures in results.items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            continue
+        for measure in MEASURES:
+            if measure not in old:
+                continue
+            ratio = measures[measure] / old[measure] if old[measure] else 1.0
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = "  REGRESSION"
+                regressions.append("%s.%s" % (name, measure))
+            print("  %-15s %-10s x%.2f%s" % (name, measure, ratio, flag))
+    return regressions
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cases", nargs="*", help="one of: %s" % ", ".join(CASES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(argv)
+    for name in args.cases:
+        if name not in CASES:
+            parser.error("unknown case %r" % name)
+    results = {}
+    for name in args.cases or CASES:
+        results[name] = run_case(CASES[name], args.repeat)
+        print(
+            "%-15s solve=%.3fs render=%.3fs peak=%.1fMiB solutions=%d knots=%d "
+            "lines=%d" % ((name,) + tuple(map(results[name].get, MEASURES)))
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "revision": git_revision(),
+                    "python": platform.python_version(),
+                    "cases": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("compared with %s:" % baseline.get("revision", args.compare))
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,4 +1,4 @@
-from .base import LayoutBlock, Options
+from .base import CacheStats, LayoutBlock, LayoutCache, Options, cache_stats
 from .blocks import (
     BlockUsageError,
     ChoiceBlock,
@@ -11,5 +11,8 @@ from .blocks import (
     WrapBlock,
 )
 from .extras import JoinedLineBlock
+from .interning import BlockInterner
+from .parallel import FormatMany, SolveInParallel
+from .profiling import ProfileEntry, Profiler
 
 __version__ = "0.1.2"
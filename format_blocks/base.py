@@ -21,14 +21,75 @@
 import io
 import re
 import sys
-from dataclasses import dataclass
-from typing import IO, Callable, Dict, List, Optional, Union
+import weakref
+from dataclasses import dataclass, fields
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-from .support import Console, Solution
+from typing_extensions import Protocol
+
+from .support import (
+    ALL_MARGINS,
+    INFINITY,
+    BufferedConsole,
+    InternSolution,
+    Margins,
+    RestrictSolution,
+    Solution,
+)
 
 ParamDict = Dict[str, Optional[Union[str, int, float, "LayoutBlock"]]]
 
 
+class _Fingerprint:
+    """ A token identifying the values of Options objects (see Options.Fingerprint). """
+
+    __slots__ = ("__weakref__",)
+
+
+# Layout caches are keyed on the fingerprint of the options used, and on the
+# continuation (rest of the line).
+CacheKey = Tuple[_Fingerprint, Optional[Solution]]
+
+# A block computes its layout in steps (see LayoutBlock.OptLayoutSteps), each
+# requesting the layout of a child block for a continuation, and the final step
+# returning the block's Solution.
+LayoutRequest = Tuple["LayoutBlock", Optional[Solution]]
+LayoutSteps = Generator[LayoutRequest, Solution, Solution]
+
+# A lower bound on the cost of a block's layouts, at any margin m and with any
+# continuation: (const, count, width) bounds the cost by const plus the costs of
+# count lines, each ending at column m + width (or further right). Only the end
+# of a line is costed, however many strings it holds (see
+# support.HPlusSolution).
+CostBound = Tuple[float, int, int]
+
+# Bounds (least, greatest) on the span of a block's layouts: the width of their
+# last line, which the rest of the line follows. The greatest may be INFINITY.
+SpanRange = Tuple[int, Union[int, float]]
+
+# A value computed for each block from those of its children (see _BottomUp).
+T = TypeVar("T")
+
+# Maps the field values of Options objects to their fingerprint, for as long as
+# the fingerprint is used (by an Options object, or a key of memoised values).
+_FINGERPRINTS: "weakref.WeakValueDictionary[Tuple[Any, ...], _Fingerprint]" = (
+    weakref.WeakValueDictionary()
+)
+
+
 @dataclass
 class Options:
     margin_0: int = 0
@@ -40,10 +101,68 @@ class Options:
     break_element_lines: Optional[
         Callable[[List[List["LayoutBlock"]]], List[List["LayoutBlock"]]]
     ] = None
+    # Compute MinSolution with the NumPy engine (requires numpy).
+    vectorize: bool = False
+    # The maximum number of Solutions memoised by each block, evicting the least
+    # recently used. None means unbounded.
+    layout_cache_size: Optional[int] = None
+    # Discard all memoised Solutions in a block tree once it has been printed.
+    clear_cache_after_render: bool = False
+    # Have Solutions record back-pointers to the Solutions they were built from,
+    # rather than building a Layout for every knot, and only build the Layouts
+    # that are printed.
+    lazy_layouts: bool = False
+    # Stop extending a line of a WrapBlock once every longer line is certain to
+    # cost more than breaking it (see WrapBlock.DoOptLayout).
+    prune_wraps: bool = False
+    # Skip laying out the alternatives of a ChoiceBlock which are certain to cost
+    # more than an alternative already laid out, at every margin (see
+    # ChoiceBlock.OptLayoutSteps). This assumes that no break_mult is negative.
+    prune_choices: bool = False
+    # Approximate the Solutions built by the solver by merging each piece of
+    # their cost functions into the previous one while the cost at any margin
+    # changes by at most knot_tolerance, and then, if a Solution still has more
+    # than max_knots knots, with larger and larger tolerances until it hasn't
+    # (see support.SolutionFactory.MkSolution). The defaults keep Solutions exact.
+    knot_tolerance: float = 0
+    max_knots: Optional[int] = None
+    # Lay out each block only for the range of margins at which it may start in
+    # the tree being laid out, rather than for every margin (see
+    # LayoutBlock.PropagateMargins), so the Solutions of blocks far from the
+    # margin, or of short lines, have fewer knots. Costs may differ by rounding
+    # errors, so layouts of equal cost may be chosen differently.
+    restrict_margins: bool = False
 
     def __post_init__(self) -> None:
         self.Check()
 
+    def __setattr__(self, name: str, value: Any) -> None:
+        super().__setattr__(name, value)
+        # Any change of option value invalidates the fingerprint.
+        self.__dict__.pop("_fingerprint", None)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Fingerprints are only meaningful within one process.
+        state = self.__dict__.copy()
+        state.pop("_fingerprint", None)
+        return state
+
+    def Fingerprint(self) -> _Fingerprint:
+        """A token identifying the values of these options.
+
+        Options objects with equal field values share a fingerprint, so layouts
+        computed for one may be reused for the other.
+        """
+        try:
+            return self.__dict__["_fingerprint"]  # type: ignore
+        except KeyError:
+            values = tuple(getattr(self, f.name) for f in fields(self))
+            fingerprint = _FINGERPRINTS.get(values)
+            if fingerprint is None:
+                fingerprint = _FINGERPRINTS[values] = _Fingerprint()
+            self.__dict__["_fingerprint"] = fingerprint
+            return fingerprint
+
     def Check(self) -> None:
         """ Assertion verification for options. """
         try:
@@ -53,19 +172,479 @@ class Options:
             assert self.margin_1_cost >= 0, "margin_1_cost"
             assert self.break_cost >= 0, "break_cost"
             assert self.late_pack_cost >= 0, "late_pack_cost"
+            assert (
+                self.layout_cache_size is None or self.layout_cache_size > 0
+            ), "layout_cache_size"
+            assert self.knot_tolerance >= 0, "knot_tolerance"
+            assert self.max_knots is None or self.max_knots >= 2, "max_knots"
         except AssertionError as e:
             raise ValueError("Illegal option value for '%s'" % e.args[0])
 
 
+@dataclass
+class CacheStats:
+    """ Counters of layout cache activity, across all blocks. """
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def Reset(self) -> None:
+        self.hits = self.misses = self.evictions = 0
+
+
+cache_stats = CacheStats()
+
+
+class SolverHooks(Protocol):
+    """ Callbacks notified as LayoutBlock.OptLayout lays out each block. """
+
+    def BlockStarted(
+        self, block: "LayoutBlock", rest_of_line: Optional[Solution], cached: bool
+    ) -> None:
+        """ Called before laying out block, or retrieving its memoised layout. """
+
+    def BlockFinished(
+        self, block: "LayoutBlock", rest_of_line: Optional[Solution], soln: Solution
+    ) -> None:
+        """ Called once the layout of the block last started is known. """
+
+
+# The hooks notified by the solver, if any (see profiling.Profiler).
+solver_hooks: Optional[SolverHooks] = None
+
+
+class LayoutCache:
+    """A memo of the Solutions computed for a block.
+
+    Entries are keyed on the options' fingerprint and the continuation, and the
+    cache may be bounded (see Options.layout_cache_size), in which case the
+    least recently used entries are evicted first.
+    """
+
+    def __init__(self) -> None:
+        # Dicts preserve insertion order, which is used as the recency order.
+        self._entries: Dict[CacheKey, Solution] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: CacheKey) -> bool:
+        return key in self._entries
+
+    def Get(self, key: CacheKey, options: Options) -> Optional[Solution]:
+        """ Retrieve the Solution for key, or None if it is not cached. """
+        soln = self._entries.get(key)
+        if soln is None:
+            cache_stats.misses += 1
+            return None
+        cache_stats.hits += 1
+        if options.layout_cache_size is not None:
+            del self._entries[key]
+            self._entries[key] = soln
+        return soln
+
+    def Put(self, key: CacheKey, soln: Solution, options: Options) -> None:
+        """ Store the Solution for key, evicting entries over the size limit. """
+        self._entries[key] = soln
+        if options.layout_cache_size is not None:
+            while len(self._entries) > options.layout_cache_size:
+                del self._entries[next(iter(self._entries))]
+                cache_stats.evictions += 1
+
+    def Solutions(self) -> List[Solution]:
+        """ The Solutions currently memoised, least recently used first. """
+        return list(self._entries.values())
+
+    def Clear(self) -> None:
+        self._entries.clear()
+
+
 class LayoutBlock:
-    """ The abstract class at base of the block hierarchy. """
+    """The abstract class at base of the block hierarchy.
+
+    Blocks have __slots__ (as must their subclasses, to keep the savings), and
+    the state they memoise is only allocated once computed, since a document
+    may have millions of blocks.
+    """
+
+    __slots__ = (
+        "is_breaking",
+        "_cache",
+        "_parents",
+        "_lower_bound",
+        "_span_bounds",
+        "_margins",
+        "__weakref__",
+    )
 
     def __init__(self, is_breaking: bool = False) -> None:
         # If a newline is mandated after this block.
         self.is_breaking = is_breaking
 
-        # See OptLayout method below for use of layout_cache.
-        self.layout_cache: Dict[Optional[Solution], Solution] = {}
+        # The layouts memoised by OptLayout: None, until the block is first laid
+        # out; then the only key and Solution, until it is laid out with another
+        # key; then a LayoutCache (see layout_cache).
+        self._cache: Union[None, Tuple[CacheKey, Solution], LayoutCache] = None
+
+        # Weak references to the blocks containing this block (see AddParent):
+        # None, a single reference, or a dict mapping the id of each block to a
+        # reference to it and the index of this block among its children.
+        self._parents: Union[
+            None,
+            "weakref.ReferenceType[LayoutBlock]",
+            Dict[int, Tuple["weakref.ReferenceType[LayoutBlock]", int]],
+        ] = None
+
+        # The fingerprint of the options for which LowerBound was last computed,
+        # and the bound.
+        self._lower_bound: Optional[Tuple[_Fingerprint, CostBound]] = None
+
+        # Likewise for SpanBounds, and the fingerprint of the options for which
+        # the range of margins of this block was last propagated, and the range.
+        self._span_bounds: Optional[Tuple[_Fingerprint, SpanRange]] = None
+        self._margins: Optional[Tuple[_Fingerprint, Margins]] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Memoised layouts are not copied (or pickled) along with blocks, nor are
+        # links to parents (which composite blocks restore for their elements).
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name != "__weakref__" and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state["_cache"] = None
+        state["_parents"] = None
+        state["_lower_bound"] = None
+        state["_span_bounds"] = None
+        state["_margins"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def layout_cache(self) -> LayoutCache:
+        """The memo of the Solutions computed for this block.
+
+        It is only allocated when first accessed, or when the block is laid out
+        with a second key; until then, OptLayout keeps the one Solution inline.
+        """
+        cache = self._cache
+        if not isinstance(cache, LayoutCache):
+            new_cache = LayoutCache()
+            if cache is not None:
+                new_cache._entries[cache[0]] = cache[1]
+            self._cache = cache = new_cache
+        return cache
+
+    def _GetLayout(self, key: CacheKey, options: Options) -> Optional[Solution]:
+        """ Retrieve the memoised Solution for key, as by LayoutCache.Get. """
+        cache = self._cache
+        if cache is None or isinstance(cache, tuple):
+            if cache is None or cache[0] != key:
+                cache_stats.misses += 1
+                return None
+            cache_stats.hits += 1
+            return cache[1]
+        return cache.Get(key, options)
+
+    def _PutLayout(self, key: CacheKey, soln: Solution, options: Options) -> None:
+        """ Memoise the Solution for key, as by LayoutCache.Put. """
+        cache = self._cache
+        if cache is None or (isinstance(cache, tuple) and cache[0] == key):
+            self._cache = (key, soln)
+        else:
+            self.layout_cache.Put(key, soln, options)
+
+    def _HasLayout(self, key: CacheKey) -> bool:
+        """ If a Solution is memoised for key. """
+        cache = self._cache
+        if cache is None or isinstance(cache, tuple):
+            return cache is not None and cache[0] == key
+        return key in cache
+
+    def Children(self) -> List["LayoutBlock"]:
+        """ The blocks contained directly in this block. """
+        return []
+
+    def FirstLeaf(self) -> "LayoutBlock":
+        """ The first block without children at the start of this block. """
+        return self
+
+    def LastLeaf(self) -> "LayoutBlock":
+        """ The last block without children at the end of this block. """
+        return self
+
+    def InternalBlocks(self) -> List["LayoutBlock"]:
+        """The blocks this block has built to lay itself out, if any.
+
+        They aren't children, but hold memoised layouts of their own (see
+        extras.CompositeShortcutMixin).
+        """
+        return []
+
+    def IndependentChildren(self, options: Options) -> List["LayoutBlock"]:
+        """The children whose layouts don't depend on this block's continuation.
+
+        These children are only ever laid out with an empty continuation (None)
+        by this block, so they may be laid out separately, in any order (see
+        parallel.SeedLayouts).
+        """
+        return []
+
+    def AddParent(self, parent: "LayoutBlock", index: int) -> None:
+        """Record that parent contains this block, as its child at index.
+
+        Parents are referred to weakly, so blocks built temporarily around this
+        one don't outlive their use. The links may go stale (when a parent's
+        children are replaced, or it is garbage collected), so Parents checks
+        them.
+        """
+        parents = self._parents
+        ref = weakref.ref(parent)
+        # weakref.ref returns the same reference for the same object, so an
+        # element repeated in a parent is recorded once.
+        if parents is None:
+            self._parents = ref
+            return
+        if not isinstance(parents, dict):
+            if parents is ref:
+                return
+            # The index of the first parent isn't kept (it is the common case,
+            # and Parents finds it by a search of the parent's children).
+            first = parents()
+            parents = self._parents = (
+                {} if first is None else {id(first): (parents, -1)}
+            )
+        # A dead parent's id may be reused by another block, which replaces it.
+        parents[id(parent)] = (ref, index)
+        # Prune dead references each time the dict doubles in size.
+        n = len(parents)
+        if n >= 8 and n & (n - 1) == 0:
+            for key, (ref, _) in list(parents.items()):
+                if ref() is None:
+                    del parents[key]
+
+    def Parents(self) -> List["LayoutBlock"]:
+        """ The blocks which contain this block directly. """
+        refs = self._parents
+        if refs is None:
+            return []
+        if not isinstance(refs, dict):
+            parent = refs()
+            if parent is not None and any(c is self for c in parent.Children()):
+                return [parent]
+            return []
+        parents: List[LayoutBlock] = []
+        for key, (ref, index) in list(refs.items()):
+            parent = ref()
+            if parent is not None:
+                children = parent.Children()
+                if not (0 <= index < len(children) and children[index] is self):
+                    # The child at index was replaced: look for this block
+                    # elsewhere, once.
+                    index = next((i for i, c in enumerate(children) if c is self), -1)
+                    if index < 0:
+                        parent = None
+                    else:
+                        refs[key] = (ref, index)
+            if parent is None:
+                del refs[key]
+            else:
+                parents.append(parent)
+        return parents
+
+    def ChildrenChanged(self) -> None:
+        """ Update any state which this block derives from its children. """
+
+    def InvalidateLayout(self) -> None:
+        """Discard the memoised layouts of this block and the blocks containing it.
+
+        This is called when the block has been edited (see
+        CompositeLayoutBlock.ReplaceElement): only the layouts of the blocks on
+        the paths from the block to the roots of the trees containing it are
+        discarded, so the next OptLayout reuses those of every other sub-tree.
+
+        The state which each block derives from its children is updated too,
+        after that of its children (a block may contain another both directly
+        and through a third).
+        """
+        # The blocks, in the post-order of a depth-first walk up their parents,
+        # so that each comes after the blocks containing it.
+        order: List[LayoutBlock] = []
+        seen = {id(self)}
+        stack: List[Tuple[LayoutBlock, Iterator[LayoutBlock]]] = [
+            (self, iter(self.Parents()))
+        ]
+        while stack:
+            block, parents = stack[-1]
+            for parent in parents:
+                if id(parent) not in seen:
+                    seen.add(id(parent))
+                    stack.append((parent, iter(parent.Parents())))
+                    break
+            else:
+                stack.pop()
+                order.append(block)
+        for block in reversed(order):
+            block._cache = None
+            block._lower_bound = block._span_bounds = block._margins = None
+            block.ChildrenChanged()
+
+    def LowerBound(self, options: Options) -> CostBound:
+        """A lower bound on the cost of this block's layouts (see CostBound).
+
+        The bound of each block is computed from those of its children (see
+        DoLowerBound), and memoised.
+        """
+        return self._BottomUp(
+            "_lower_bound",
+            lambda block, bounds: block.DoLowerBound(bounds, options),
+            options,
+        )
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        """Compute a lower bound on the cost of this block's layouts.
+
+        Args:
+          child_bounds: the bounds of the children, in the order of Children().
+        Returns:
+          The bound for this block. By default, just that its costs are not
+          negative.
+        """
+        return (0.0, 0, 0)
+
+    def SpanBounds(self, options: Options) -> SpanRange:
+        """Bounds on the span of this block's layouts (see base.SpanRange).
+
+        The bounds of each block are computed from those of its children (see
+        DoSpanBounds), and memoised.
+        """
+        return self._BottomUp(
+            "_span_bounds",
+            lambda block, bounds: block.DoSpanBounds(bounds, options),
+            options,
+        )
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        """Compute bounds on the span of this block's layouts.
+
+        Args:
+          child_bounds: the bounds of the children, in the order of Children().
+        Returns:
+          The bounds for this block. By default, no bounds at all.
+        """
+        return (0, INFINITY)
+
+    def _BottomUp(
+        self,
+        attr: str,
+        compute: Callable[["LayoutBlock", List[T]], T],
+        options: Options,
+    ) -> T:
+        """Compute a value of each block of this tree from those of its children.
+
+        The value of each block is computed by compute, from the block and the
+        values of its children, and memoised, with the fingerprint of the
+        options, in its attribute attr.
+        """
+        fingerprint = options.Fingerprint()
+        memo: Optional[Tuple[_Fingerprint, T]] = getattr(self, attr)
+        if memo is not None and memo[0] == fingerprint:
+            return memo[1]
+        stack: List[Tuple[LayoutBlock, bool]] = [(self, False)]
+        while stack:
+            block, children_done = stack.pop()
+            memo = getattr(block, attr)
+            if memo is not None and memo[0] == fingerprint:
+                continue
+            if not children_done:
+                stack.append((block, True))
+                stack.extend((child, False) for child in block.Children())
+                continue
+            values = [getattr(child, attr)[1] for child in block.Children()]
+            setattr(block, attr, (fingerprint, compute(block, values)))
+        result: Tuple[_Fingerprint, T] = getattr(self, attr)
+        return result[1]
+
+    def MarginRange(self, options: Options) -> Margins:
+        """ The range of margins at which this block is laid out. """
+        if (
+            options.restrict_margins
+            and self._margins is not None
+            and self._margins[0] == options.Fingerprint()
+        ):
+            return self._margins[1]
+        return ALL_MARGINS
+
+    def ChildMargins(self, margins: Margins, options: Options) -> List[Margins]:
+        """The ranges of margins at which the children of this block may start.
+
+        Args:
+          margins: the range of margins at which this block may start.
+        Returns:
+          A range for each child, in the order of Children(). By default, every
+          margin.
+        """
+        return [ALL_MARGINS] * len(self.Children())
+
+    def PropagateMargins(self, margins: Margins, options: Options) -> None:
+        """Extend the ranges of margins at which the blocks of this tree are laid out.
+
+        With options.restrict_margins, the Solution memoised for a block is only
+        computed, and so only valid, for the margins in its range (see
+        MarginRange), which covers the ranges the block has been given in every
+        tree containing it. When a block's range is extended, its memoised
+        Solutions are discarded, and the ranges of its children extended in turn.
+        """
+        fingerprint = options.Fingerprint()
+        # Make sure that the span bounds are memoised throughout the tree.
+        self.SpanBounds(options)
+        stack: List[Tuple[LayoutBlock, Margins]] = [(self, margins)]
+        while stack:
+            block, (lo, hi) = stack.pop()
+            if block._margins is not None:
+                old_fingerprint, (old_lo, old_hi) = block._margins
+                if old_fingerprint == fingerprint:
+                    if old_lo <= lo and hi <= old_hi:
+                        continue
+                    lo, hi = min(lo, old_lo), max(hi, old_hi)
+                block._cache = None
+            block._margins = (fingerprint, (lo, hi))
+            internal = block.InternalBlocks()
+            if internal:
+                # The block is laid out as the blocks it has built (which are
+                # built along with its span bounds), and its children only
+                # within them, so those take its range instead.
+                stack.extend((b, (lo, hi)) for b in internal)
+                continue
+            children = block.Children()
+            if children:
+                stack.extend(zip(children, block.ChildMargins((lo, hi), options)))
+
+    def StructuralKey(self) -> Optional[Hashable]:
+        """The parameters which, with its class and children, identify this block.
+
+        Blocks of the same class with equal keys and identical children lay out
+        identically, and so may be shared (see interning.BlockInterner). None
+        means that the block must never be shared.
+        """
+        return None
+
+    def ClearLayoutCache(self) -> None:
+        """ Discard the memoised layouts of this block and all its descendants. """
+        stack: List[LayoutBlock] = [self]
+        while stack:
+            block = stack.pop()
+            block._cache = None
+            stack.extend(block.Children())
+            stack.extend(block.InternalBlocks())
 
     def Parms(self) -> ParamDict:
         """ A dictionary containing the parameters of this block. """
@@ -87,28 +666,105 @@ class LayoutBlock:
             + self.ReprParms()
         )
 
-    def OptLayout(self, rest_of_line: Optional[Solution], options: Options) -> Solution:
+    def OptLayout(
+        self,
+        rest_of_line: Optional[Solution],
+        options: Options,
+        margins: Margins = ALL_MARGINS,
+    ) -> Solution:
         """Retrieve or compute the least-cost (optimum) layout for this block.
 
         Args:
           rest_of_line: a Solution object representing the text to the right of
             this block.
+          margins: the range of margins at which the Solution is used. Unless
+            options.restrict_margins is set, it is computed for every margin.
         Returns:
           A Solution object representing the optimal layout for this block and
           the rest of the line.
         """
-        # Deeply-nested choice block may result in the same continuation supplied
-        # repeatedly to the same block. Without memoisation, this may result in an
-        # exponential blow-up in the layout algorithm.
-        if rest_of_line not in self.layout_cache:
-            self.layout_cache[rest_of_line] = self.DoOptLayout(rest_of_line, options)
-        return self.layout_cache[rest_of_line]
+        if options.restrict_margins:
+            self.PropagateMargins(margins, options)
+        # The blocks of the tree are laid out in post-order, with an explicit
+        # stack of the blocks whose layout is in progress (rather than by
+        # recursion, which would limit the depth of block trees), each with the
+        # steps of its layout and the key under which the layout is memoised.
+        stack: List[Tuple[LayoutSteps, LayoutBlock, Optional[Solution], CacheKey]] = []
+        hooks = solver_hooks
+        request: Optional[LayoutRequest] = (self, rest_of_line)
+        while True:
+            if request is not None:
+                block, continuation = request
+                # Deeply-nested choice block may result in the same continuation
+                # supplied repeatedly to the same block. Without memoisation, this
+                # may result in an exponential blow-up in the layout algorithm. The
+                # options form part of the key, since the same block may be laid
+                # out under different options. Note that a bounded cache
+                # (options.layout_cache_size) which is too small to hold all the
+                # continuations of a block brings this blow-up back.
+                key = (options.Fingerprint(), continuation)
+                soln = block._GetLayout(key, options)
+                if hooks is not None:
+                    hooks.BlockStarted(block, continuation, soln is not None)
+                if soln is None:
+                    steps = block.OptLayoutSteps(continuation, options)
+                    stack.append((steps, block, continuation, key))
+                else:
+                    if hooks is not None:
+                        hooks.BlockFinished(block, continuation, soln)
+                    if not stack:
+                        return soln
+            steps, block, continuation, key = stack[-1]
+            try:
+                # soln is None at the first step, and is otherwise the layout of
+                # the child requested by the previous step.
+                request = steps.send(soln)  # type: ignore
+            except StopIteration as stop:
+                stack.pop()
+                # Canonical Solutions make equal continuations hit the same entries.
+                margins = block.MarginRange(options)
+                if margins != ALL_MARGINS:
+                    soln = RestrictSolution(stop.value, margins)
+                else:
+                    soln = InternSolution(stop.value)
+                block._PutLayout(key, soln, options)
+                if hooks is not None:
+                    hooks.BlockFinished(block, continuation, soln)
+                if not stack:
+                    return soln
+                request = None
+
+    def OptLayoutSteps(
+        self, rest_of_line: Optional[Solution], options: Options
+    ) -> LayoutSteps:
+        """Compute the least-cost (optimum) layout for this block, in steps.
+
+        This is a generator: to use the layout of a child block for a given
+        continuation, it yields the pair (child, continuation), and is sent back
+        the child's (memoised) Solution. It returns the Solution for this block.
+        Blocks override either this method or DoOptLayout; this default simply
+        calls DoOptLayout, so any child layouts it needs are computed by
+        recursive calls of OptLayout.
+
+        Args:
+          rest_of_line: a Solution object representing the text to the right of
+            this block.
+        Returns:
+          A Solution object representing the optimal layout for this block and
+          the rest of the line.
+        """
+        return self.DoOptLayout(rest_of_line, options)
+        yield  # Unreachable, but makes this method a generator.
 
     def DoOptLayout(
         self, rest_of_line: Optional[Solution], options: Options
     ) -> Solution:
         """Compute the least-cost (optimum) layout for this block.
 
+        Blocks override either this method or OptLayoutSteps; this default
+        runs OptLayoutSteps, laying out the children it requests with OptLayout.
+        A block which overrides neither raises NotImplementedError.
+
         Args:
           rest_of_line: a Solution object representing the text to the right of
             this block.
@@ -116,7 +772,20 @@ class LayoutBlock:
           A Solution object representing the optimal layout for this block and
           the rest of the line.
         """
-        # Abstract method.
+        if type(self).OptLayoutSteps is LayoutBlock.OptLayoutSteps:
+            # Otherwise each default would call the other forever.
+            raise NotImplementedError(
+                f"{type(self).__name__} overrides neither DoOptLayout nor "
+                "OptLayoutSteps"
+            )
+        steps = self.OptLayoutSteps(rest_of_line, options)
+        soln: Optional[Solution] = None
+        while True:
+            try:
+                child, continuation = steps.send(soln)  # type: ignore
+            except StopIteration as stop:
+                return stop.value  # type: ignore
+            soln = child.OptLayout(continuation, options)
 
     def PrintOn(self, options: Options, outp: IO[str]) -> None:
         """Print the contents of this block with the optimal layout.
@@ -124,11 +793,28 @@ class LayoutBlock:
         Args:
           outp: a stream on which output is to be printed.
         """
-        soln = self.OptLayout(None, options)
+        soln = self.OptLayout(None, options, margins=(0, 0))
         if soln:
-            Console(outp, options.margin_0, options.margin_1).PrintLayout(
-                soln.layouts[0]
+            BufferedConsole(outp, options.margin_0, options.margin_1).PrintLayout(
+                soln.LayoutAt(0)
             )
+        if options.clear_cache_after_render:
+            self.ClearLayoutCache()
+
+    def IterLines(self, options: Options) -> Iterator[str]:
+        """Generate the lines (without newlines) of this block's optimal layout.
+
+        Each line is generated as soon as it has been printed, so the output
+        needn't be held in memory: "\\n".join(block.IterLines(options)) is
+        block.Render(options).
+        """
+        soln = self.OptLayout(None, options, margins=(0, 0))
+        if soln:
+            # Nothing is written to the stream: the lines are generated instead.
+            console = BufferedConsole(io.StringIO(), options.margin_0, options.margin_1)
+            yield from console.Lines(soln.LayoutAt(0), final=True)
+        if options.clear_cache_after_render:
+            self.ClearLayoutCache()
 
     def Print(self, options: Options) -> None:
         self.PrintOn(options, outp=sys.stdout)
@@ -15,12 +15,25 @@
 
 """ A block language system for building language formatters. """
 
-from itertools import chain
-from typing import Iterable, List, Optional, Sequence
+import weakref
+from bisect import bisect_right
+from itertools import islice
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    cast,
+)
 
 from . import support
-from .base import LayoutBlock, Options, ParamDict
-from .support import Solution
+from .base import CostBound, LayoutBlock, LayoutSteps, Options, ParamDict, SpanRange
+from .support import Margins, Solution
 
 
 class BlockUsageError(Exception):
@@ -30,6 +43,8 @@ class BlockUsageError(Exception):
 class TextBlock(LayoutBlock):
     """ A block containing a single unbroken string. """
 
+    __slots__ = ("text",)
+
     def __init__(self, text: str, is_breaking: bool = False):
         super().__init__(is_breaking)
         self.text = text
@@ -37,77 +52,248 @@ class TextBlock(LayoutBlock):
     def __repr__(self) -> str:
         return "*" * self.is_breaking + self.text
 
+    def StructuralKey(self) -> Hashable:
+        return (self.text, self.is_breaking)
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        return (0.0, 1, len(self.text))
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        return (len(self.text), len(self.text))
+
     def DoOptLayout(
         self, rest_of_line: Optional[Solution], options: Options
     ) -> Solution:
-        span = len(self.text)
-        layout = support.Layout([support.LayoutElement.String(self.text)])
-        # The costs associated with the layout of this block may require 1, 2 or 3
-        # knots, depending on how the length of the text compares with the two
-        # margins (m0 and m1) in options. Note that we assume
-        # options.margin_1 >= options.margin_0 >= 0, as asserted in base.Options.Check().
-        if span >= options.margin_1:
-            s = support.Solution(
-                [0],
-                [span],
-                [
-                    (span - options.margin_0) * options.margin_0_cost
-                    + (span - options.margin_1) * options.margin_1
-                ],
-                [options.margin_0_cost + options.margin_1_cost],
-                [layout],
-                options=options,
-            )
-        elif span >= options.margin_0:
-            s = support.Solution(
-                [0, options.margin_1 - span],
-                [span] * 2,
-                [
-                    (span - options.margin_0) * options.margin_0_cost,
-                    (options.margin_1 - options.margin_0) * options.margin_0_cost,
-                ],
-                [options.margin_0_cost, options.margin_0_cost + options.margin_1_cost],
-                [layout] * 2,
-                options=options,
-            )
-        else:
-            s = support.Solution(
-                [0, options.margin_0 - span, options.margin_1 - span],
-                [span] * 3,
-                [0, 0, (options.margin_1 - options.margin_0) * options.margin_0_cost],
-                [
-                    0,
-                    options.margin_0_cost,
-                    options.margin_0_cost + options.margin_1_cost,
-                ],
-                [layout] * 3,
-                options=options,
-            )
-        return s.WithRestOfLine(rest_of_line)
+        return TextSolution(self.text, options).WithRestOfLine(
+            rest_of_line, self.MarginRange(options)
+        )
+
+
+# The knots, spans, intercepts and gradients of a Solution's cost function.
+_Costs = Tuple[Sequence[int], Sequence[int], Sequence[float], Sequence[float]]
+
+# The cost functions of texts of each length, keyed on the options' fingerprint
+# and the length (the Solutions of the texts share their arrays). At most
+# _TEXT_COSTS_SIZE are kept, evicting the least recently used, as in a bounded
+# base.LayoutCache.
+_TEXT_COSTS: Dict[Tuple[Hashable, int], _Costs] = {}
+_TEXT_COSTS_SIZE = 1024
+
+
+def _TextCosts(span: int, options: Options) -> _Costs:
+    """ The cost function of a text of length span, as in TextSolution. """
+    # The costs associated with the layout of this block may require 1, 2 or 3
+    # knots, depending on how the length of the text compares with the two
+    # margins (m0 and m1) in options. Note that we assume
+    # options.margin_1 >= options.margin_0 >= 0, as asserted in base.Options.Check().
+    if span >= options.margin_1:
+        s = support.Solution(
+            [0],
+            [span],
+            [
+                (span - options.margin_0) * options.margin_0_cost
+                + (span - options.margin_1) * options.margin_1
+            ],
+            [options.margin_0_cost + options.margin_1_cost],
+            [],
+            options=options,
+        )
+    elif span >= options.margin_0:
+        s = support.Solution(
+            [0, options.margin_1 - span],
+            [span] * 2,
+            [
+                (span - options.margin_0) * options.margin_0_cost,
+                (options.margin_1 - options.margin_0) * options.margin_0_cost,
+            ],
+            [options.margin_0_cost, options.margin_0_cost + options.margin_1_cost],
+            [],
+            options=options,
+        )
+    else:
+        s = support.Solution(
+            [0, options.margin_0 - span, options.margin_1 - span],
+            [span] * 3,
+            [0, 0, (options.margin_1 - options.margin_0) * options.margin_0_cost],
+            [
+                0,
+                options.margin_0_cost,
+                options.margin_0_cost + options.margin_1_cost,
+            ],
+            [],
+            options=options,
+        )
+    return (s.knots, s.spans, s.intercepts, s.gradients)
+
+
+def TextSolution(text: str, options: Options) -> Solution:
+    """The Solution laying out a single unbroken string.
+
+    Its cost function depends only on the length of the text and the options,
+    so it is computed once for each length (and options), and only the Layout
+    printing the text is built for each Solution.
+    """
+    key = (options.Fingerprint(), len(text))
+    costs = _TEXT_COSTS.pop(key, None)
+    if costs is None:
+        costs = _TextCosts(len(text), options)
+        if len(_TEXT_COSTS) >= _TEXT_COSTS_SIZE:
+            del _TEXT_COSTS[next(iter(_TEXT_COSTS))]
+    _TEXT_COSTS[key] = costs
+    layout = support.Layout([support.LayoutElement.String(text)], key=("String", text))
+    knots, spans, intercepts, gradients = costs
+    return support.Solution(
+        knots, spans, intercepts, gradients, [layout] * len(knots), options=options
+    )
+
+
+class _SharedElements:
+    """The elements of a block built by extending another (see CompositeLayoutBlock).
+
+    The elements are the first length entries of store, a list shared by the
+    blocks of a chain of extensions, each using a prefix of it.
+    """
+
+    __slots__ = ("store", "length")
+
+    def __init__(self, store: List[LayoutBlock], length: int) -> None:
+        self.store = store
+        self.length = length
+
+    def __iter__(self) -> Iterator[LayoutBlock]:
+        return islice(self.store, self.length)
 
 
 class CompositeLayoutBlock(LayoutBlock):
     """The abstract superclass of blocks which contain other blocks (elements).
 
     Note that we assume at least one element.
+
+    Blocks built by extending a block (see the extended methods) share its
+    elements (see _ExtendedElements), so a block may be extended n times in
+    O(n) time, while the blocks extended remain valid. The elements of such a
+    block are only copied out when they are first needed (see elements).
     """
 
+    __slots__ = ("_shared", "_elements", "_first_leaf", "_last_leaf")
+
     def __init__(self, elements: Iterable[LayoutBlock]) -> None:
         super().__init__()
-        self.elements: List[LayoutBlock] = list(elements)
-
-        if not self.elements:
+        # The elements, shared with other blocks (or None, if not shared).
+        self._shared: Optional[_SharedElements] = None
+        if isinstance(elements, _SharedElements):
+            self._shared = elements
+            self._elements: Optional[List[LayoutBlock]] = None
+            first, last = elements.store[0], elements.store[elements.length - 1]
+            self.is_breaking = last.is_breaking
+            self._first_leaf = first.FirstLeaf()
+            self._last_leaf = last.LastLeaf()
+            return
+
+        self._elements = list(elements)
+
+        if not self._elements:
             raise BlockUsageError(
                 "Composite Layout Blocks must contain at least one element."
             )
 
-        for e in self.elements:
+        for e in self._elements:
             if not isinstance(e, LayoutBlock):
                 raise TypeError(f"{e} is not a LayoutBlock")
+        self._LinkElements()
 
         self.is_breaking = (
-            True if self.elements and self.elements[-1].is_breaking else False
+            True if self._elements and self._elements[-1].is_breaking else False
         )
+        # Those of the elements, so FirstLeaf and LastLeaf take constant time.
+        self._first_leaf = self._elements[0].FirstLeaf()
+        self._last_leaf = self._elements[-1].LastLeaf()
+
+    def _LinkElements(self) -> None:
+        """ Record that this block contains its elements (see AddParent). """
+        for i, e in enumerate(self.elements):
+            # An inlined e.AddParent(self, i), for the common case of a
+            # parentless element.
+            if e._parents is None:
+                e._parents = weakref.ref(self)
+            else:
+                e.AddParent(self, i)
+
+    @property
+    def elements(self) -> List[LayoutBlock]:
+        elements = self._elements
+        if elements is None:
+            shared = cast(_SharedElements, self._shared)
+            elements = self._elements = shared.store[: shared.length]
+            self._LinkElements()
+        return elements
+
+    def _ExtendedElements(self, new_elements: Iterable[LayoutBlock]) -> _SharedElements:
+        """The elements of a block extending this one with new_elements.
+
+        They share the list of this block's elements, which is appended to in
+        place if no other block has extended this one, and otherwise copied.
+        """
+        shared = self._shared
+        if shared is None:
+            store = list(self.elements)
+        elif len(shared.store) == shared.length:
+            store = shared.store
+        else:
+            store = shared.store[: shared.length]
+        for e in new_elements:
+            if not isinstance(e, LayoutBlock):
+                raise TypeError(f"{e} is not a LayoutBlock")
+            store.append(e)
+        return _SharedElements(store, len(store))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        state = super().__getstate__()
+        state["_elements"] = self.elements
+        state["_shared"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        super().__setstate__(state)
+        for i, e in enumerate(self.elements):
+            e.AddParent(self, i)
+
+    def Children(self) -> List[LayoutBlock]:
+        return self.elements
+
+    def FirstLeaf(self) -> LayoutBlock:
+        return self._first_leaf
+
+    def LastLeaf(self) -> LayoutBlock:
+        return self._last_leaf
+
+    def ChildrenChanged(self) -> None:
+        elements = self.elements
+        # The elements may have been replaced, so they are no longer shared.
+        self._shared = None
+        self.is_breaking = elements[-1].is_breaking
+        self._first_leaf = elements[0].FirstLeaf()
+        self._last_leaf = elements[-1].LastLeaf()
+
+    def ReplaceElement(self, index: int, element: LayoutBlock) -> LayoutBlock:
+        """Replace one of the elements of this block, returning the old element.
+
+        The layouts memoised by this block and the blocks containing it are
+        discarded (see LayoutBlock.InvalidateLayout), but those of all other
+        blocks are kept, so laying out the tree again only recomputes the
+        layouts on the paths from this block to the roots.
+        """
+        if not isinstance(element, LayoutBlock):
+            raise TypeError(f"{element} is not a LayoutBlock")
+        old = self.elements[index]
+        self.elements[index] = element
+        element.AddParent(self, index)
+        self.InvalidateLayout()
+        return old
 
     def ReprLayoutBlocks(self) -> str:
         return "[%s]" % (", ".join(e.__repr__() for e in self.elements))
@@ -119,19 +305,19 @@ class CompositeLayoutBlock(LayoutBlock):
 class LineBlock(CompositeLayoutBlock):
     """ A block that places its elements in a single line. """
 
+    __slots__ = ()
+
     def __init__(self, elements: Iterable[LayoutBlock]) -> None:
         super().__init__(elements)
 
     def extended(self, new_elements: Iterable[LayoutBlock]) -> "LineBlock":
-        return self.__class__(chain(self.elements, new_elements))
+        return self.__class__(self._ExtendedElements(new_elements))
 
-    def DoOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
-        if not self.elements:
-            assert rest_of_line
-            return rest_of_line
+    def StructuralKey(self) -> Hashable:
+        return ()
 
+    def ElementLines(self, options: Options) -> List[List[LayoutBlock]]:
+        """ The elements, split into lines after each breaking element. """
         element_lines: List[List[LayoutBlock]] = [[]]
 
         for i, elt in enumerate(self.elements):
@@ -142,36 +328,187 @@ class LineBlock(CompositeLayoutBlock):
         if len(element_lines) > 1 and callable(options.break_element_lines):
             element_lines = options.break_element_lines(element_lines)
 
+        return element_lines
+
+    def IndependentChildren(self, options: Options) -> List[LayoutBlock]:
+        # The last element of each line but the last ends the line.
+        return [ln[-1] for ln in self.ElementLines(options)[:-1] if ln]
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        line_breaks = options.break_cost * (len(self.ElementLines(options)) - 1)
+        if callable(options.break_element_lines):
+            # The lines may not hold all the elements.
+            return (line_breaks, 0, 0)
+        # Each element starts where the one before it ends, so each line ends at
+        # least the sum of the widths of its elements right of the margin.
+        widths = {id(e): _Width(b) for e, b in zip(self.elements, child_bounds)}
+        return (
+            line_breaks + sum(b[0] for b in child_bounds),
+            len(self.ElementLines(options)),
+            min(sum(widths[id(e)] for e in ln) for ln in self.ElementLines(options)),
+        )
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        if callable(options.break_element_lines):
+            return super().DoSpanBounds(child_bounds, options)
+        # The span is that of the last line, the sum of its elements' spans.
+        n_last = len(self.ElementLines(options)[-1])
+        last_line = child_bounds[len(child_bounds) - n_last :]
+        return (sum(b[0] for b in last_line), sum(b[1] for b in last_line))
+
+    def ChildMargins(self, margins: Margins, options: Options) -> List[Margins]:
+        if callable(options.break_element_lines):
+            return super().ChildMargins(margins, options)
+        lo, hi = margins
+        child_margins = []
+        for ln in self.ElementLines(options):
+            # Each element of a line starts after the spans of those before it.
+            least, greatest = lo, hi
+            for elt in ln:
+                child_margins.append((least, greatest))
+                elt_least, elt_greatest = elt.SpanBounds(options)
+                least, greatest = least + elt_least, greatest + elt_greatest
+        return child_margins
+
+    def OptLayoutSteps(
+        self, rest_of_line: Optional[Solution], options: Options
+    ) -> LayoutSteps:
+        if not self.elements:
+            assert rest_of_line
+            return rest_of_line
+
+        element_lines = self.ElementLines(options)
         line_solns = []
         for i, ln in enumerate(element_lines):
             ln_layout = None if i < len(element_lines) - 1 else rest_of_line
             for elt in ln[::-1]:
-                ln_layout = elt.OptLayout(ln_layout, options)
+                ln_layout = yield elt, ln_layout
             line_solns.append(ln_layout)
-        soln = support.VSumSolution(list(filter(None, line_solns)), options)
+        soln = support.VSumSolution(
+            list(filter(None, line_solns)), options, self.MarginRange(options)
+        )
         return soln.PlusConst(options.break_cost * (len(line_solns) - 1))
 
 
 class ChoiceBlock(CompositeLayoutBlock):
     """ A block which contains alternate layouts of the same content. """
 
+    __slots__ = ()
+
     # Note: All elements of a ChoiceBlock are breaking, if any are.
     def __init__(self, elements: Iterable[LayoutBlock]) -> None:
         super().__init__(elements)
 
-    def DoOptLayout(
+    def StructuralKey(self) -> Hashable:
+        return ()
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        return (
+            min(b[0] for b in child_bounds),
+            min(b[1] for b in child_bounds),
+            min(b[2] for b in child_bounds),
+        )
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        return (min(b[0] for b in child_bounds), max(b[1] for b in child_bounds))
+
+    def ChildMargins(self, margins: Margins, options: Options) -> List[Margins]:
+        return [margins] * len(self.elements)
+
+    def OptLayoutSteps(
         self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    ) -> LayoutSteps:
         # The optimum layout of this block is simply the piecewise minimum of its
         # elements' layouts.
-        return support.MinSolution(
-            [e.OptLayout(rest_of_line, options) for e in self.elements], options
-        )
+        margins = self.MarginRange(options)
+        element_solns = []
+        if not options.prune_choices:
+            for e in self.elements:
+                element_solns.append((yield e, rest_of_line))
+            return support.MinSolution(element_solns, options, margins)
+        # An element whose lower bound is more than the cost of another element's
+        # layout at every margin can't contribute to the minimum (not even on a
+        # tie), so it is skipped. Elements with lower bounds are laid out first,
+        # as they are the most likely to rule out others.
+        bounds = [e.LowerBound(options) for e in self.elements]
+        solns: Dict[int, Solution] = {}
+        for i in sorted(range(len(self.elements)), key=lambda i: bounds[i][0]):
+            if not any(_CostsLess(s, bounds[i], options) for s in solns.values()):
+                solns[i] = yield self.elements[i], rest_of_line
+        return support.MinSolution([solns[i] for i in sorted(solns)], options, margins)
+
+
+def _SumBounds(const: float, bounds: List[CostBound]) -> CostBound:
+    """ The lower bound on the cost of blocks stacked one below another, plus const. """
+    return (
+        const + sum(b[0] for b in bounds),
+        sum(b[1] for b in bounds),
+        min(b[2] for b in bounds),
+    )
+
+
+def _Width(bound: CostBound) -> int:
+    """The width right of its margin at which a block's lines end, at least.
+
+    The width of a bound which counts no lines bounds nothing, so it is 0.
+    """
+    return bound[2] if bound[1] else 0
+
+
+def _MarginCost(options: Options) -> float:
+    """A lower bound on the cost of each column of a string past margin_1.
+
+    The cost of a string (see TextSolution) grows by options.margin_1 for each
+    column past margin_1 at margin 0, and by options.margin_1_cost for each
+    column further right.
+    """
+    return min(options.margin_1, options.margin_1_cost)
+
+
+def _BoundValueAt(bound: CostBound, m: int, options: Options) -> float:
+    """ The value of a lower bound (see base.CostBound) at margin m. """
+    const, count, width = bound
+    end = m + width
+    return const + count * (
+        max(0, end - options.margin_0) * options.margin_0_cost
+        + max(0, end - options.margin_1) * _MarginCost(options)
+    )
+
+
+def _CostsLess(soln: Solution, bound: CostBound, options: Options) -> bool:
+    """Whether soln costs strictly less than the bound, at every margin.
+
+    Both are piecewise linear in the margin, so they need only be compared at
+    the ends of the pieces of soln and at the knots of the bound, and beyond
+    the last of those, by gradient.
+    """
+    knots = soln.knots
+    margins = set(knots)
+    margins.update(k - 1 for k in knots[1:])
+    for margin in (options.margin_0, options.margin_1):
+        margins.add(max(0, margin - bound[2]))
+    for m in margins:
+        i = bisect_right(knots, m) - 1
+        value = soln.intercepts[i] + soln.gradients[i] * (m - knots[i])
+        if value >= _BoundValueAt(bound, m, options):
+            return False
+    bound_gradient = bound[1] * (options.margin_0_cost + _MarginCost(options))
+    return soln.gradients[-1] <= bound_gradient
 
 
 class MultBreakBlock(CompositeLayoutBlock):
     """ The abstract superclass of blocks that locally modify line break cost. """
 
+    __slots__ = ("break_mult",)
+
     def __init__(self, elements: Iterable[LayoutBlock], break_mult: float = 1) -> None:
         super().__init__(elements)
         self.break_mult = break_mult
@@ -183,17 +520,40 @@ class MultBreakBlock(CompositeLayoutBlock):
 class StackBlock(MultBreakBlock):
     """ A block that arranges its elements vertically, separated by line breaks. """
 
+    __slots__ = ()
+
     def __init__(self, elements: Iterable[LayoutBlock], break_mult: float = 1):
         super().__init__(elements, break_mult)
 
     def extended(self, new_elements: Iterable[LayoutBlock]) -> "StackBlock":
         return self.__class__(
-            chain(self.elements, new_elements), break_mult=self.break_mult
+            self._ExtendedElements(new_elements), break_mult=self.break_mult
         )
 
-    def DoOptLayout(
+    def StructuralKey(self) -> Hashable:
+        return (self.break_mult,)
+
+    def IndependentChildren(self, options: Options) -> List[LayoutBlock]:
+        return self.elements[:-1]
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        breaks = options.break_cost * self.break_mult * (len(self.elements) - 1)
+        return _SumBounds(breaks, child_bounds)
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        # The last line is that of the last element.
+        return child_bounds[-1] if child_bounds else (0, 0)
+
+    def ChildMargins(self, margins: Margins, options: Options) -> List[Margins]:
+        return [margins] * len(self.elements)
+
+    def OptLayoutSteps(
         self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    ) -> LayoutSteps:
         # The optimum layout for this block arranges the elements vertically. Only
         # the final element is composed with the continuation provided---all the
         # others see an empty continuation ("None"), since they face the end of
@@ -201,11 +561,11 @@ class StackBlock(MultBreakBlock):
         if not self.elements:
             assert rest_of_line
             return rest_of_line
-        soln = support.VSumSolution(
-            [e.OptLayout(None, options) for e in self.elements[:-1]]
-            + [self.elements[-1].OptLayout(rest_of_line, options)],
-            options,
-        )
+        element_solns = []
+        for e in self.elements[:-1]:
+            element_solns.append((yield e, None))
+        element_solns.append((yield self.elements[-1], rest_of_line))
+        soln = support.VSumSolution(element_solns, options, self.MarginRange(options))
         # Under some odd circumstances involving comments, we may have a degenerate
         # solution.
         if soln is None:
@@ -219,6 +579,8 @@ class StackBlock(MultBreakBlock):
 class WrapBlock(MultBreakBlock):
     """ A block that arranges its elements like a justified paragraph. """
 
+    __slots__ = ("sep", "prefix")
+
     def __init__(
         self,
         elements: Iterable[LayoutBlock],
@@ -230,12 +592,11 @@ class WrapBlock(MultBreakBlock):
         self.break_mult = break_mult
         self.sep = sep
         self.prefix = prefix
-        self.elt_is_breaking = [e.is_breaking for e in elements]
-        self.n = len(self.elements)
 
     def extended(self, new_elements: Iterable[LayoutBlock]) -> "WrapBlock":
         return self.__class__(
-            chain(self.elements, new_elements),
+            self._ExtendedElements(new_elements),
+            sep=self.sep,
             break_mult=self.break_mult,
             prefix=self.prefix,
         )
@@ -243,28 +604,86 @@ class WrapBlock(MultBreakBlock):
     def Parms(self) -> ParamDict:
         return {**super().Parms(), "sep": self.sep, "prefix": self.prefix}
 
-    def DoOptLayout(
+    def StructuralKey(self) -> Hashable:
+        return (self.break_mult, self.sep, self.prefix)
+
+    def IndependentChildren(self, options: Options) -> List[LayoutBlock]:
+        return self.elements
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        # A line ends after each breaking element, and each line holds at least
+        # one element.
+        n_breaking = sum(e.is_breaking for e in self.elements[:-1])
+        breaks = n_breaking * options.break_cost * self.break_mult
+        return (
+            breaks + sum(b[0] for b in child_bounds),
+            n_breaking + 1,
+            min(_Width(b) for b in child_bounds),
+        )
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        if not child_bounds:
+            return (0, 0)
+        # The last line holds at least the last element, and at most all of them.
+        indent = len(self.prefix) if self.prefix else 0
+        seps = len(self.sep) * (len(child_bounds) - 1)
+        return (
+            indent + child_bounds[-1][0],
+            indent + seps + sum(b[1] for b in child_bounds),
+        )
+
+    def ChildMargins(self, margins: Margins, options: Options) -> List[Margins]:
+        # Each element may start a line (after the prefix), or follow all of the
+        # elements before it on the line.
+        lo, hi = margins
+        indent = len(self.prefix) if self.prefix else 0
+        child_margins = []
+        greatest = hi + indent
+        for elt in self.elements:
+            child_margins.append((lo + indent, greatest))
+            greatest += elt.SpanBounds(options)[1] + len(self.sep)
+        return child_margins
+
+    def OptLayoutSteps(
         self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    ) -> LayoutSteps:
         # Computing the optimum layout for this class of block involves finding the
         # optimal packing of elements into lines, a problem which we address using
         # dynamic programming.
-        sep_layout = TextBlock(self.sep).OptLayout(None, options)
-        assert sep_layout is not None
-        # TODO(pyelland): Investigate why OptLayout doesn't work here.
-        prefix_layout = (
-            TextBlock(self.prefix).DoOptLayout(None, options) if self.prefix else None
-        )
-        elt_layouts = [e.OptLayout(None, options) for e in self.elements]
+        elements = self.elements
+        n = len(elements)
+        sep_layout = TextSolution(self.sep, options)
+        prefix_layout = TextSolution(self.prefix, options) if self.prefix else None
+        elt_layouts = []
+        for e in elements:
+            elt_layouts.append((yield e, None))
+        # The cost of a line is that of the columns it occupies past the margins,
+        # so past margin_1 each separator added to a line costs sep_cost. Starting
+        # a new line costs at most indent_cost, for the columns before the first
+        # element, if the block starts no further right than prune_limit.
+        # See the use of prune_gain below.
+        prune_gain = -support.INFINITY
+        prune_limit = options.margin_1 - (len(self.prefix) if self.prefix else 0)
+        if options.prune_wraps and len(self.sep) < options.margin_1:
+            sep_cost = len(self.sep) * (options.margin_0_cost + options.margin_1_cost)
+            indent_cost = (options.margin_1 - options.margin_0) * options.margin_0_cost
+            prune_gain = sep_cost - indent_cost
+        break_cost = options.break_cost * self.break_mult
+        # Every line starts at the block's margin.
+        margins = self.MarginRange(options)
         # Entry i in the list wrap_solutions contains the optimum layout for the
         # last n - i elements of the block.
-        wrap_solutions: List[Optional[Solution]] = [None] * self.n
+        wrap_solutions: List[Optional[Solution]] = [None] * n
         # Note that we compute the entries for wrap_solutions in reverse order,
         # at each iteration considering all the elements from i ... n - 1 (the
         # actual number of elements considered increases by one on each iteration).
         # This means that the complete solution, with elements 0 ... n - 1 is
         # computed last.
-        for i in range(self.n - 1, -1, -1):
+        for i in range(n - 1, -1, -1):
             # To calculate wrap_solutions[i], consider breaking the last n - i
             # elements after element j, for j = i ... n - 1.
             # By induction, wrap_solutions contains the optimum layout of the
@@ -279,37 +698,57 @@ class WrapBlock(MultBreakBlock):
             if prefix_layout is None:
                 line_layout = elt_layouts[i]
             else:
-                line_layout = prefix_layout.WithRestOfLine(elt_layouts[i])
+                line_layout = prefix_layout.WithRestOfLine(elt_layouts[i], margins)
+            # The margins at which the layouts with longer lines are needed.
+            line_margins = margins
 
-            last_breaking = self.elements[i].is_breaking
-            for j in range(i, self.n - 1):
+            last_breaking = elements[i].is_breaking
+            for j in range(i, n - 1):
                 solution_j = wrap_solutions[j + 1]
                 assert solution_j
-                full_soln = support.VSumSolution([line_layout, solution_j], options)
+                full_soln = support.VSumSolution(
+                    [line_layout, solution_j], options, line_margins
+                )
                 # We adjust the cost of the full solution by adding the cost of the
                 # line break we've introduced, and a small penalty
                 # (options.late_pack_cost) to favor (ceteris paribus) layouts with
                 # elements packed into earlier lines.
                 solutions_i.append(
-                    full_soln.PlusConst(
-                        options.break_cost * self.break_mult
-                        + options.late_pack_cost * (self.n - j)
-                    )
+                    full_soln.PlusConst(break_cost + options.late_pack_cost * (n - j))
                 )
                 # If the element at the end of the line mandates a following line break,
                 # we're done.
                 if last_breaking:
                     break
-                # Otherwise, add a separator and the next element to the line layout
-                # and continue.
+                # If the line already reaches margin_1 at every starting margin, any
+                # longer line puts a separator past margin_1. Moving the elements
+                # after that separator onto a new line instead (which by induction
+                # wrap_solutions[j + 1] accounts for) saves at least prune_gain, and
+                # costs one more break and late packing penalty. If that is a net
+                # saving, no longer line is optimal for a block starting at a margin
+                # up to prune_limit, so the longer lines are only laid out for the
+                # margins further right, if any. (Below those, their Solutions
+                # extend their cost at the first, which is no less than the exact
+                # one, so they aren't chosen there.)
+                if (
+                    prune_gain > break_cost + options.late_pack_cost * (n - j)
+                    and min(line_layout.spans) >= options.margin_1
+                ):
+                    if margins[1] <= prune_limit:
+                        break
+                    line_margins = (max(margins[0], prune_limit + 1), margins[1])
+                # Add a separator and the next element to the line layout and
+                # continue.
                 sep_elt_layout = sep_layout.WithRestOfLine(elt_layouts[j + 1])
                 assert line_layout is not None
-                line_layout = line_layout.WithRestOfLine(sep_elt_layout)
-                last_breaking = self.elements[j + 1].is_breaking
+                line_layout = line_layout.WithRestOfLine(sep_elt_layout, line_margins)
+                last_breaking = elements[j + 1].is_breaking
             else:  # Not executed if last_breaking
                 assert line_layout is not None
-                solutions_i.append(line_layout.WithRestOfLine(rest_of_line))
-            wrap_solutions[i] = support.MinSolution(solutions_i, options)
+                solutions_i.append(
+                    line_layout.WithRestOfLine(rest_of_line, line_margins)
+                )
+            wrap_solutions[i] = support.MinSolution(solutions_i, options, margins)
         # Once wrap_solutions is complete, the optimum layout for the entire block
         # is the optimum layout for the last n - 0 elements.
         result = wrap_solutions[0]
@@ -320,6 +759,8 @@ class WrapBlock(MultBreakBlock):
 class VerbBlock(LayoutBlock):
     """ A block that prints out several lines of text verbatim. """
 
+    __slots__ = ("lines", "first_nl")
+
     def __init__(
         self, lines: Sequence[str], is_breaking: bool = True, first_nl: bool = False
     ):
@@ -330,6 +771,20 @@ class VerbBlock(LayoutBlock):
     def __repr__(self) -> str:
         return self.lines[0][:3] + "..." + self.lines[-1][-3:]
 
+    def StructuralKey(self) -> Hashable:
+        return (tuple(self.lines), self.is_breaking, self.first_nl)
+
+    def DoLowerBound(
+        self, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        # The lines are costed as an empty string at the margin.
+        return (0.0, 1, 0)
+
+    def DoSpanBounds(
+        self, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        return (0, 0)
+
     def DoOptLayout(
         self, rest_of_line: Optional[Solution], options: Options
     ) -> Solution:
@@ -340,7 +795,7 @@ class VerbBlock(LayoutBlock):
             if i > 0 or self.first_nl:
                 l_elts.append(support.LayoutElement.NewLine())
             l_elts.append(support.LayoutElement.String(ln))
-        layout = support.Layout(l_elts)
+        layout = support.Layout(l_elts, key=("Verb", tuple(self.lines), self.first_nl))
         span = 0
         sf = support.SolutionFactory()
         if options.margin_0 > 0:  # Prevent incoherent solutions
@@ -4,12 +4,11 @@
 #   the base set. The APIs here are not set in stone yet and may
 #   be modified or removed!
 
-from itertools import chain
-from typing import Container, Iterable, List, Optional, Union, cast
+from typing import Any, Container, Dict, Iterable, List, Optional, Union, cast
 
 from typing_extensions import Protocol
 
-from .base import LayoutBlock, Options, ParamDict
+from .base import CostBound, LayoutBlock, LayoutSteps, Options, ParamDict, SpanRange
 from .blocks import (
     ChoiceBlock,
     CompositeLayoutBlock,
@@ -50,31 +49,74 @@ def optionally_indented(
 
 
 class CompositeShotcutBlock(Protocol):
+    _lowered: Optional[LayoutBlock]
+
     @property
     def elements(self) -> List[LayoutBlock]:
         ...
 
-    def CompositeOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    def CompositeLowered(self) -> LayoutBlock:
+        ...
+
+    def Lowered(self) -> LayoutBlock:
         ...
 
 
 class CompositeShortcutMixin:
-    """ A Mixin for easing the implementation of blocks which contain a list of zero or more elements. """
+    """A Mixin for easing the implementation of blocks which contain a list of zero or more elements.
 
-    elements: List[LayoutBlock] = []
+    Such a block is laid out as a tree of other blocks, built by its
+    CompositeLowered method when it has two or more elements. The tree is built
+    once, and kept until the elements change, so the layouts it memoises are
+    reused whatever the continuation of the block.
+    """
 
-    def DoOptLayout(
-        self: CompositeShotcutBlock, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
-        if not self.elements:
-            return TextBlock("").OptLayout(rest_of_line, options)
+    __slots__ = ()
+
+    elements: List[LayoutBlock]
+    # The block tree which this block is laid out as, once built (see Lowered).
+    # It is a slot of each class using the mixin (since only one base of a class
+    # may have slots), set to None by its __init__.
+    _lowered: Optional[LayoutBlock]
+
+    def Lowered(self: CompositeShotcutBlock) -> LayoutBlock:
+        """ The block tree which this block is laid out as. """
+        if self._lowered is None:
+            if not self.elements:
+                self._lowered = TextBlock("")
+            elif len(self.elements) == 1:
+                self._lowered = self.elements[0]
+            else:
+                self._lowered = self.CompositeLowered()
+        return self._lowered
 
-        if len(self.elements) == 1:
-            return self.elements[0].OptLayout(rest_of_line, options)
+    def InternalBlocks(self: CompositeShotcutBlock) -> List[LayoutBlock]:
+        return [] if self._lowered is None else [self._lowered]
 
-        return self.CompositeOptLayout(rest_of_line, options)
+    def ChildrenChanged(self: CompositeShotcutBlock) -> None:
+        super().ChildrenChanged()  # type: ignore
+        self._lowered = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The tree is rebuilt (along with its layouts) when it is next needed.
+        state: Dict[str, Any] = super().__getstate__()  # type: ignore
+        state["_lowered"] = None
+        return state
+
+    def DoLowerBound(
+        self: CompositeShotcutBlock, child_bounds: List[CostBound], options: Options
+    ) -> CostBound:
+        return self.Lowered().LowerBound(options)
+
+    def DoSpanBounds(
+        self: CompositeShotcutBlock, child_bounds: List[SpanRange], options: Options
+    ) -> SpanRange:
+        return self.Lowered().SpanBounds(options)
+
+    def OptLayoutSteps(
+        self: CompositeShotcutBlock, rest_of_line: Optional[Solution], options: Options
+    ) -> LayoutSteps:
+        return (yield self.Lowered(), rest_of_line)
 
 
 class JoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
@@ -82,6 +124,8 @@ class JoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
     like [].join(str)
     """
 
+    __slots__ = ("joiner", "join_breaking", "_lowered")
+
     def __init__(
         self,
         elements: Iterable[LayoutBlock],
@@ -89,11 +133,16 @@ class JoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
         join_breaking: bool = False,
     ):
         super().__init__(elements)
+        self._lowered = None
         self.joiner = joiner
         self.join_breaking = join_breaking
 
     def extended(self, new_elements: Iterable[LayoutBlock]) -> "JoinedLineBlock":
-        return self.__class__(chain(self.elements, new_elements), joiner=self.joiner)
+        return self.__class__(
+            self._ExtendedElements(new_elements),
+            joiner=self.joiner,
+            join_breaking=self.join_breaking,
+        )
 
     def Parms(self) -> ParamDict:
         return {
@@ -102,15 +151,9 @@ class JoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
             "join_breaking": self.join_breaking,
         }
 
-    def CompositeOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    def CompositeLowered(self) -> LayoutBlock:
         joiner = TextBlock(self.joiner) if isinstance(self.joiner, str) else self.joiner
 
-        elements = [
-            e for e in self.elements if not (isinstance(e, TextBlock) and e.text == "")
-        ]
-
         joined: List[LayoutBlock] = []
         for element in self.elements[:-1]:
             joined.append(element)
@@ -119,12 +162,13 @@ class JoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
 
         joined.append(self.elements[-1])
 
-        block = LineBlock(joined)
-        return block.OptLayout(rest_of_line, options)
+        return LineBlock(joined)
 
 
 class _ConditionalJoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
-    """ TODO: document """
+    """ A JoinedLineBlock which omits the joiner around some texts, such as "(". """
+
+    __slots__ = ("joiner", "no_space_left", "no_space_right", "_lowered")
 
     def __init__(
         self,
@@ -134,6 +178,7 @@ class _ConditionalJoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
         no_space_right: Container[str] = frozenset({".", "("}),
     ) -> None:
         super().__init__(elements)
+        self._lowered = None
         self.joiner = joiner
         self.no_space_left = no_space_left
         self.no_space_right = no_space_right
@@ -142,17 +187,18 @@ class _ConditionalJoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
         self, new_elements: Iterable[LayoutBlock]
     ) -> "_ConditionalJoinedLineBlock":
         return self.__class__(
-            chain(self.elements, new_elements),
+            self._ExtendedElements(new_elements),
             joiner=self.joiner,
             no_space_left=self.no_space_left,
             no_space_right=self.no_space_right,
         )
 
-    def CompositeOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    def CompositeLowered(self) -> LayoutBlock:
+        # Elements are joined without a space when the first text of one, or
+        # the last text of the one before it, calls for it. The texts are kept
+        # by the blocks (see LayoutBlock.FirstLeaf), so this takes linear time.
         result = [[self.elements[0]]]
-        end = ""
+        end = get_end_text(self.elements[0])
         for element in self.elements[1:]:
             start = get_start_text(element)
             if (start in self.no_space_left) or (end in self.no_space_right):
@@ -161,43 +207,43 @@ class _ConditionalJoinedLineBlock(CompositeShortcutMixin, CompositeLayoutBlock):
                 result.append([element])
             end = get_end_text(element)
 
-        return JoinedLineBlock(
-            [LineBlock(x) for x in result], joiner=self.joiner
-        ).OptLayout(rest_of_line, options)
+        return JoinedLineBlock([LineBlock(x) for x in result], joiner=self.joiner)
 
 
 class _JoinedStackBlock(CompositeShortcutMixin, MultBreakBlock):
     """ TODO: document """
 
+    __slots__ = ("joiner", "_lowered")
+
     def __init__(
         self,
         elements: Iterable[LayoutBlock],
-        joiner: LayoutBlock = TextBlock(","),
+        joiner: Union[str, LayoutBlock] = TextBlock(","),
         break_mult: float = 1,
     ):
         super().__init__(elements, break_mult)
+        self._lowered = None
         self.joiner = joiner
 
     def extended(self, new_elements: Iterable[LayoutBlock]) -> "_JoinedStackBlock":
         return self.__class__(
-            chain(self.elements, new_elements),
+            self._ExtendedElements(new_elements),
             break_mult=self.break_mult,
             joiner=self.joiner,
         )
 
-    def CompositeOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    def CompositeLowered(self) -> LayoutBlock:
         joiner = TextBlock(self.joiner) if isinstance(self.joiner, str) else self.joiner
 
         first: List[LayoutBlock] = [LineBlock([x, joiner]) for x in self.elements[:-1]]
-        block = StackBlock(first + [self.elements[-1]], break_mult=self.break_mult)
-        return block.OptLayout(rest_of_line, options)
+        return StackBlock(first + [self.elements[-1]], break_mult=self.break_mult)
 
 
 class _WrapIfLongBlock(CompositeShortcutMixin, MultBreakBlock):
     """ TODO: document """
 
+    __slots__ = ("prefix", "sep", "wrap_len", "_lowered")
+
     def __init__(
         self,
         elements: Iterable[LayoutBlock],
@@ -207,38 +253,33 @@ class _WrapIfLongBlock(CompositeShortcutMixin, MultBreakBlock):
         wrap_len: int = 3,
     ):
         super().__init__(elements, break_mult=break_mult)
+        self._lowered = None
         self.prefix = prefix
         self.sep = sep
         self.wrap_len = wrap_len
 
     def extended(self, elements: Iterable[LayoutBlock]) -> "_WrapIfLongBlock":
         return self.__class__(
-            chain(self.elements, elements),
+            self._ExtendedElements(elements),
             sep=self.sep,
             break_mult=self.break_mult,
             prefix=self.prefix,
             wrap_len=self.wrap_len,
         )
 
-    def CompositeOptLayout(
-        self, rest_of_line: Optional[Solution], options: Options
-    ) -> Solution:
+    def CompositeLowered(self) -> LayoutBlock:
         if len(self.elements) >= self.wrap_len:
-            block: LayoutBlock = WrapBlock(
+            return WrapBlock(
                 self.elements,
                 sep=self.sep,
                 break_mult=self.break_mult,
                 prefix=self.prefix,
             )
-        else:
-            block = JoinedLineBlock(self.elements, joiner=TextBlock(self.sep))
-        return block.OptLayout(rest_of_line, options)
+        return JoinedLineBlock(self.elements, joiner=TextBlock(self.sep))
 
 
 def get_start(element: LayoutBlock) -> LayoutBlock:
-    if isinstance(element, CompositeLayoutBlock):
-        return get_start(element.elements[0])
-    return element
+    return element.FirstLeaf()
 
 
 def get_start_text(element: LayoutBlock) -> str:
@@ -246,9 +287,7 @@ def get_start_text(element: LayoutBlock) -> str:
 
 
 def get_end(element: LayoutBlock) -> LayoutBlock:
-    if isinstance(element, CompositeLayoutBlock):
-        return get_start(element.elements[-1])
-    return element
+    return element.LastLeaf()
 
 
 def get_end_text(element: LayoutBlock) -> str:
@@ -0,0 +1,75 @@
+#  Copyright 2020 Joseph Atkins-Turkish, Apache License.
+#
+#  Hash-consing of block trees: structurally equal blocks are replaced by a
+#   single shared (interned) block, so that they also share one layout cache.
+
+from typing import Dict, Hashable, List, Tuple
+
+from .base import LayoutBlock
+
+
+class BlockInterner:
+    """A table of canonical blocks, used to share structurally equal sub-trees.
+
+    Two blocks are structurally equal if they are of the same class, have equal
+    StructuralKey()s, and their children are (recursively) structurally equal.
+    Interning a tree replaces every such sub-tree with one canonical instance,
+    so that each distinct sub-tree is laid out only once per continuation.
+
+    The table persists between calls to Intern, so the same interner may be
+    used for many documents: sub-trees shared between documents are then also
+    laid out only once, provided the documents are formatted with equal Options
+    (layout caches are keyed on the options' fingerprint).
+    """
+
+    def __init__(self) -> None:
+        self._table: Dict[Tuple[type, Hashable, Tuple[int, ...]], LayoutBlock] = {}
+
+    def __len__(self) -> int:
+        return len(self._table)
+
+    def Clear(self) -> None:
+        """ Forget all canonical blocks (and, with them, their layout caches). """
+        self._table.clear()
+
+    def Intern(self, block: LayoutBlock) -> LayoutBlock:
+        """Return the canonical block structurally equal to 'block'.
+
+        Note that the element lists of the blocks in the tree passed in are
+        updated in place to refer to canonical children; blocks which cannot be
+        shared (those whose StructuralKey() is None) are kept, but their
+        children are still interned.
+        """
+        # Maps the ids of the blocks visited to their canonical blocks. The
+        # blocks themselves are kept alive by the tree, so their ids are stable.
+        canonical: Dict[int, LayoutBlock] = {}
+        # A post-order traversal, with an explicit stack so that deep trees
+        # don't exhaust the recursion limit.
+        stack: List[Tuple[LayoutBlock, bool]] = [(block, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in canonical:
+                continue
+            children = node.Children()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend(
+                    (child, False) for child in children if id(child) not in canonical
+                )
+                continue
+            rewired = False
+            for i, child in enumerate(children):
+                if canonical[id(child)] is not child:
+                    children[i] = canonical[id(child)]
+                    children[i].AddParent(node, i)
+                    rewired = True
+            if rewired:
+                node.ChildrenChanged()
+            key = node.StructuralKey()
+            if key is None:
+                canonical[id(node)] = node
+            else:
+                canonical[id(node)] = self._table.setdefault(
+                    (type(node), key, tuple(map(id, children))), node
+                )
+        return canonical[id(block)]
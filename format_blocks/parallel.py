@@ -0,0 +1,218 @@
+#  Copyright 2020 Joseph Atkins-Turkish, Apache License.
+#
+#  Parallel layout of the independent sub-trees of a block tree, in a pool of
+#   worker processes.
+
+import io
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .base import LayoutBlock, Options
+from .interning import BlockInterner
+from .support import Solution
+
+# The interner shared by the documents formatted in this (worker) process, and
+# the number of canonical blocks beyond which it is emptied (see FormatMany).
+_INTERNER = BlockInterner()
+MAX_INTERNED_BLOCKS = 1 << 18
+
+
+def _SubtreeSizes(block: LayoutBlock) -> Dict[int, int]:
+    """ The number of blocks in each sub-tree of block, keyed on its id. """
+    sizes: Dict[int, int] = {}
+    stack: List[Tuple[LayoutBlock, bool]] = [(block, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in sizes:
+            continue
+        if not children_done:
+            stack.append((node, True))
+            stack.extend(
+                (child, False) for child in node.Children() if id(child) not in sizes
+            )
+            continue
+        sizes[id(node)] = 1 + sum(sizes[id(child)] for child in node.Children())
+    return sizes
+
+
+def _SolveChunk(blocks: List[LayoutBlock], options: Options) -> List[Solution]:
+    """ Lay out each of the blocks with an empty continuation (in a worker). """
+    return [block.OptLayout(None, options) for block in blocks]
+
+
+def FindIndependentSubtrees(
+    block: LayoutBlock, options: Options, max_size: int, min_size: int = 1
+) -> List[LayoutBlock]:
+    """Find sub-trees of block which may be laid out independently.
+
+    These are the independent children (see LayoutBlock.IndependentChildren)
+    of block and its descendants, with between min_size and max_size blocks,
+    in document order. Larger sub-trees are searched for smaller ones instead;
+    sub-trees whose layout is already memoised are skipped.
+    """
+    sizes = _SubtreeSizes(block)
+    key = (options.Fingerprint(), None)
+    subtrees: List[LayoutBlock] = []
+    seen: Set[int] = set()
+    stack = [block]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        independent = set(map(id, node.IndependentChildren(options)))
+        descend = []
+        for child in node.Children():
+            size = sizes[id(child)]
+            if id(child) in independent and min_size <= size <= max_size:
+                if id(child) not in seen and not child._HasLayout(key):
+                    subtrees.append(child)
+                seen.add(id(child))
+            elif size > min_size:
+                descend.append(child)
+        stack.extend(reversed(descend))
+    return subtrees
+
+
+def SeedLayouts(
+    block: LayoutBlock,
+    options: Options,
+    executor: Executor,
+    workers: Optional[int] = None,
+    min_task_size: int = 64,
+    tasks_per_worker: int = 4,
+) -> int:
+    """Lay out the independent sub-trees of block in parallel.
+
+    The sub-trees are laid out by the executor, in chunks of about
+    1 / (workers * tasks_per_worker) of the tree, and their Solutions are
+    memoised in the sub-trees' layout caches, so that laying out block itself
+    (in this process) only has to lay out the rest of the tree. Sub-trees of
+    fewer than min_task_size blocks aren't worth sending to a worker.
+
+    With a ProcessPoolExecutor, the sub-trees, their Solutions and the options
+    are pickled (so any Options.break_element_lines must be picklable).
+
+    Args:
+      workers: the number of workers of the executor (by default, the number of
+        CPUs).
+    Returns:
+      The number of sub-trees laid out.
+    """
+    workers = workers or os.cpu_count() or 1
+    sizes = _SubtreeSizes(block)
+    max_size = max(min_task_size, sizes[id(block)] // (workers * tasks_per_worker))
+    subtrees = FindIndependentSubtrees(block, options, max_size, min_task_size)
+    chunks: List[List[LayoutBlock]] = [[]]
+    chunk_size = 0
+    for subtree in subtrees:
+        if chunk_size >= max_size:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(subtree)
+        chunk_size += sizes[id(subtree)]
+    futures = [executor.submit(_SolveChunk, chunk, options) for chunk in chunks]
+    key = (options.Fingerprint(), None)
+    for chunk, future in zip(chunks, futures):
+        for subtree, soln in zip(chunk, future.result()):
+            subtree._PutLayout(key, soln, options)
+    return len(subtrees)
+
+
+def SolveInParallel(
+    block: LayoutBlock,
+    options: Options,
+    executor: Optional[Executor] = None,
+    workers: Optional[int] = None,
+) -> Solution:
+    """Compute the optimum layout of block, laying out sub-trees in parallel.
+
+    This is equivalent to block.OptLayout(None, options), but independent
+    sub-trees are laid out by SeedLayouts, in the executor given or else in a
+    new pool of worker processes.
+    """
+    if executor is None:
+        with ProcessPoolExecutor(workers) as pool:
+            SeedLayouts(block, options, pool, workers)
+    else:
+        SeedLayouts(block, options, executor, workers)
+    return block.OptLayout(None, options)
+
+
+def _FormatChunk(blocks: List[LayoutBlock], options: Options) -> List[str]:
+    """ Render each of the blocks (in a worker), sharing equal sub-trees. """
+    if len(_INTERNER) > MAX_INTERNED_BLOCKS:
+        _INTERNER.Clear()
+    stream = io.StringIO()
+    ends = []
+    for block in blocks:
+        _INTERNER.Intern(block).PrintOn(options, stream)
+        ends.append(stream.tell())
+    text = stream.getvalue()
+    return [text[start:end] for start, end in zip([0] + ends, ends)]
+
+
+def _Chunks(
+    blocks: Iterable[LayoutBlock], chunk_size: int
+) -> Iterator[List[LayoutBlock]]:
+    """Group consecutive blocks into chunks of about chunk_size blocks in all.
+
+    Documents of chunk_size blocks or more get a chunk to themselves, so that
+    the documents around them are laid out by other workers meanwhile.
+    """
+    chunk: List[LayoutBlock] = []
+    size = 0
+    for block in blocks:
+        block_size = _SubtreeSizes(block)[id(block)]
+        if chunk and (block_size >= chunk_size or size + block_size > chunk_size):
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(block)
+        size += block_size
+    if chunk:
+        yield chunk
+
+
+def FormatMany(
+    blocks: Iterable[LayoutBlock],
+    options: Options,
+    executor: Optional[Executor] = None,
+    workers: Optional[int] = None,
+    chunk_size: int = 4096,
+    tasks_per_worker: int = 4,
+) -> Iterator[str]:
+    """Render many documents in a pool of worker processes.
+
+    This generates block.Render(options) for each of the blocks, in order. The
+    blocks are sent to the workers in chunks of about chunk_size blocks, and
+    each worker interns the documents it renders in one BlockInterner (which it
+    keeps for as long as the process lives, up to MAX_INTERNED_BLOCKS blocks),
+    so that equal sub-trees, such as equal TextBlocks, are laid out only once
+    per worker. Pass the same executor to many calls to keep its workers (and
+    so their interned blocks) between calls.
+
+    At most workers * tasks_per_worker chunks are in progress at once, so the
+    blocks may be generated lazily as well.
+
+    Args:
+      executor: the executor which renders the chunks (by default, a new pool
+        of worker processes).
+      workers: the number of workers of the executor (by default, the number of
+        CPUs).
+    """
+    workers = workers or os.cpu_count() or 1
+    if executor is None:
+        with ProcessPoolExecutor(workers) as pool:
+            yield from FormatMany(
+                blocks, options, pool, workers, chunk_size, tasks_per_worker
+            )
+        return
+    pending: Deque["Future[List[str]]"] = deque()
+    for chunk in _Chunks(blocks, chunk_size):
+        if len(pending) >= workers * tasks_per_worker:
+            yield from pending.popleft().result()
+        pending.append(executor.submit(_FormatChunk, chunk, options))
+    while pending:
+        yield from pending.popleft().result()
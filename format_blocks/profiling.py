@@ -0,0 +1,214 @@
+#  Copyright 2020 Joseph Atkins-Turkish, Apache License.
+#
+#  Opt-in instrumentation of the layout solver: call counts, cache hits, times
+#   and knot counts per block class and block instance, reported as a table or
+#   as collapsed stacks (for flame graphs).
+
+import time
+from dataclasses import dataclass
+from typing import IO, Any, Callable, Dict, List, Optional, Tuple
+
+from . import base, support
+from .base import LayoutBlock
+from .support import Solution
+
+# The support combinators which are instrumented.
+COMBINATORS = ("HPlusSolution", "VSumSolution", "MinSolution")
+
+
+@dataclass
+class ProfileEntry:
+    """ The measurements accumulated for one block class, block or combinator. """
+
+    calls: int = 0
+    cache_hits: int = 0
+    # The time spent in calls, including nested calls (counted once if the
+    # entry is itself re-entered, as happens for nested blocks of one class).
+    total_time: float = 0
+    # The time spent in calls, excluding nested instrumented calls.
+    self_time: float = 0
+    # The knots of the Solutions passed in (continuations, for blocks) and
+    # returned.
+    knots_in: int = 0
+    knots_out: int = 0
+
+
+class _Frame:
+    """ An instrumented call in progress. """
+
+    __slots__ = ("label", "entries", "start", "child_time")
+
+    def __init__(self, label: str, entries: List[ProfileEntry]) -> None:
+        self.label = label
+        self.entries = entries
+        self.start = time.perf_counter()
+        self.child_time = 0.0
+
+
+class Profiler:
+    """Instruments the layout solver while enabled.
+
+    Use as a context manager:
+
+        with Profiler() as profiler:
+            block.Render(options)
+        print(profiler.Table())
+
+    While enabled, the profiler is notified by LayoutBlock.OptLayout as each
+    block is laid out (see base.SolverHooks), and the support combinators are
+    replaced with instrumented versions. Both are undone once disabled, so that
+    the solver runs at full speed when no profiler is enabled. Only one
+    profiler may be enabled at a time.
+    """
+
+    _enabled: Optional["Profiler"] = None
+
+    def __init__(self) -> None:
+        # Entries are keyed on the class name for blocks, the function name for
+        # combinators, and on "ClassName@id" for block instances.
+        self.by_class: Dict[str, ProfileEntry] = {}
+        self.by_instance: Dict[str, ProfileEntry] = {}
+        # The self time spent in each stack of labels, outermost first.
+        self.stacks: Dict[Tuple[str, ...], float] = {}
+        self._frames: List[_Frame] = []
+        # The number of frames in progress for each entry (by id).
+        self._active: Dict[int, int] = {}
+        self._originals: Dict[str, Any] = {}
+
+    def __enter__(self) -> "Profiler":
+        self.Enable()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.Disable()
+
+    def Enable(self) -> None:
+        if Profiler._enabled is not None:
+            raise RuntimeError("Another Profiler is already enabled")
+        Profiler._enabled = self
+        base.solver_hooks = self
+        for name in COMBINATORS:
+            self._originals[name] = getattr(support, name)
+            setattr(support, name, self._WrapCombinator(name, getattr(support, name)))
+
+    def Disable(self) -> None:
+        if Profiler._enabled is not self:
+            return
+        base.solver_hooks = None
+        for name in COMBINATORS:
+            setattr(support, name, self._originals.pop(name))
+        Profiler._enabled = None
+
+    def Reset(self) -> None:
+        """ Discard the measurements made so far. """
+        self.by_class.clear()
+        self.by_instance.clear()
+        self.stacks.clear()
+
+    def _Push(self, label: str, entries: List[ProfileEntry]) -> None:
+        frame = _Frame(label, entries)
+        self._frames.append(frame)
+        for entry in entries:
+            self._active[id(entry)] = self._active.get(id(entry), 0) + 1
+
+    def _Pop(self, knots_in: int, result: Solution) -> None:
+        frame = self._frames.pop()
+        elapsed = time.perf_counter() - frame.start
+        stack = tuple(f.label for f in self._frames) + (frame.label,)
+        self_time = elapsed - frame.child_time
+        self.stacks[stack] = self.stacks.get(stack, 0) + self_time
+        if self._frames:
+            self._frames[-1].child_time += elapsed
+        for entry in frame.entries:
+            entry.calls += 1
+            entry.self_time += self_time
+            entry.knots_in += knots_in
+            entry.knots_out += len(result.knots)
+            # Only the outermost frame of a re-entered entry counts towards its
+            # total time.
+            self._active[id(entry)] -= 1
+            if not self._active[id(entry)]:
+                entry.total_time += elapsed
+
+    def BlockStarted(
+        self, block: LayoutBlock, rest_of_line: Optional[Solution], cached: bool
+    ) -> None:
+        label = block.__class__.__name__
+        instance = "%s@%x" % (label, id(block))
+        entries = [
+            self.by_class.setdefault(label, ProfileEntry()),
+            self.by_instance.setdefault(instance, ProfileEntry()),
+        ]
+        if cached:
+            for entry in entries:
+                entry.cache_hits += 1
+        self._Push(label, entries)
+
+    def BlockFinished(
+        self, block: LayoutBlock, rest_of_line: Optional[Solution], soln: Solution
+    ) -> None:
+        self._Pop(len(rest_of_line.knots) if rest_of_line else 0, soln)
+
+    def _WrapCombinator(
+        self, name: str, combinator: Callable[..., Solution]
+    ) -> Callable[..., Solution]:
+        entries = [self.by_class.setdefault(name, ProfileEntry())]
+
+        def Combinator(*args: Any) -> Solution:
+            solutions = args[:2] if name == "HPlusSolution" else args[0]
+            self._Push(name, entries)
+            result = combinator(*args)
+            self._Pop(sum(len(s.knots) for s in solutions), result)
+            return result
+
+        return Combinator
+
+    def Table(self, by_instance: bool = False, limit: Optional[int] = None) -> str:
+        """A table of the measurements, sorted by decreasing self time.
+
+        Args:
+          by_instance: report each block instance, rather than each block class
+            (combinators are only reported by name).
+          limit: the maximum number of rows reported.
+        """
+        entries = self.by_instance if by_instance else self.by_class
+        rows = sorted(entries.items(), key=lambda item: -item[1].self_time)[:limit]
+        width = max([len(name) for name, _ in rows] + [4])
+        lines = [
+            "%-*s %8s %8s %9s %9s %10s %10s"
+            % (
+                width,
+                "name",
+                "calls",
+                "hits",
+                "total_s",
+                "self_s",
+                "knots_in",
+                "knots_out",
+            )
+        ]
+        for name, e in rows:
+            lines.append(
+                "%-*s %8d %8d %9.4f %9.4f %10d %10d"
+                % (
+                    width,
+                    name,
+                    e.calls,
+                    e.cache_hits,
+                    e.total_time,
+                    e.self_time,
+                    e.knots_in,
+                    e.knots_out,
+                )
+            )
+        return "\n".join(lines)
+
+    def WriteCollapsed(self, outp: IO[str]) -> None:
+        """Write the self time of each stack in the "collapsed" format.
+
+        Each line holds the labels of a stack (outermost first) separated by
+        semicolons, and the self time spent in it in microseconds, as read by
+        flame graph tools such as flamegraph.pl and speedscope.
+        """
+        for stack, self_time in sorted(self.stacks.items()):
+            outp.write("%s %d\n" % (";".join(stack), round(self_time * 1e6)))
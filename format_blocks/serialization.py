@@ -0,0 +1,377 @@
+#  Copyright 2020 Joseph Atkins-Turkish, Apache License.
+#
+#  A compact binary format for block trees, so that a tree built in one process
+#   may be formatted in another without pickling it.
+#
+#  The format (all integers are little-endian, and unsigned) is:
+#
+#  - A header (_HEADER): the magic bytes, the version of the format, and the
+#    numbers of nodes, of words and of strings.
+#  - The node table: a 16 byte record (_NODE) for each distinct block, each
+#    block's children before the block, so the root is the last. A record holds
+#    the block's type tag, its flags, its number of children, and its first two
+#    operands (see _Encode).
+#  - The words: a run for each block, in the order of the node table, of the
+#    indices in the node table of its children, followed by its operands beyond
+#    the first two. A block shared in the tree is stored once, and referred to
+#    by every block containing it.
+#  - The string table: the offset in the string pool of each (distinct) string,
+#    and the end of the last.
+#  - The string pool: the strings, UTF-8 encoded.
+#
+#  Options are not part of the format: each process formats the blocks it loads
+#   with options of its own.
+
+import mmap
+import struct
+import sys
+from array import array
+from typing import Container, Dict, List, Optional, Sequence, Tuple, Union
+
+from .base import LayoutBlock
+from .blocks import ChoiceBlock, LineBlock, StackBlock, TextBlock, VerbBlock, WrapBlock
+from .extras import (
+    JoinedLineBlock,
+    _ConditionalJoinedLineBlock,
+    _JoinedStackBlock,
+    _WrapIfLongBlock,
+)
+
+_MAGIC = b"FBLK"
+_VERSION = 1
+# Magic, version, nodes, words, strings, and a reserved word which keeps the
+# node table 8-byte aligned.
+_HEADER = struct.Struct("<4sIIIII")
+# Tag, flags, children, and the first two operands.
+_NODE = struct.Struct("<BBxxIII")
+# A float operand, as two words.
+_FLOAT = struct.Struct("<d")
+_FLOAT_WORDS = struct.Struct("<II")
+# The operand of a string which is None.
+_NONE = 0xFFFFFFFF
+
+_TAGS: Dict[type, int] = {
+    TextBlock: 1,
+    VerbBlock: 2,
+    LineBlock: 3,
+    ChoiceBlock: 4,
+    StackBlock: 5,
+    WrapBlock: 6,
+    JoinedLineBlock: 7,
+    _ConditionalJoinedLineBlock: 8,
+    _JoinedStackBlock: 9,
+    _WrapIfLongBlock: 10,
+}
+# The number of operands of the blocks of each tag (see _Encode), and of those
+# beyond the first two, in their runs of words.
+_OPERANDS = [0, 1, 0, 0, 0, 2, 4, 1, 3, 3, 5]
+_EXTRA_WORDS = [max(0, n - 2) for n in _OPERANDS]
+
+# Flags.
+_BREAKING = 1
+_FIRST_NL = 2
+_JOIN_BREAKING = 4
+# The joiner is a block, the last child, rather than a string.
+_JOINER_BLOCK = 8
+# no_space_left and no_space_right are sets of strings (see _EncodeContainer),
+# rather than strings.
+_LEFT_SET = 16
+_RIGHT_SET = 32
+# break_mult is an int (such as the default, 1), rather than a float.
+_INT_MULT = 64
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+
+class _Writer:
+    """ The node table, words and strings of a tree being dumped. """
+
+    def __init__(self) -> None:
+        self.nodes = bytearray()
+        self.words = array("I")
+        self.strings: Dict[str, int] = {}
+        self.pool = bytearray()
+        self.offsets = array("I", [0])
+
+    def String(self, text: Optional[str]) -> int:
+        """ The index of text in the string table, adding it if need be. """
+        if text is None:
+            return _NONE
+        index = self.strings.get(text)
+        if index is None:
+            index = self.strings[text] = len(self.offsets) - 1
+            self.pool += text.encode("utf-8")
+            self.offsets.append(len(self.pool))
+        return index
+
+    def Node(self, tag: int, flags: int, refs: List[int], operands: List[int]) -> None:
+        """ Add the record and the run of words of a block. """
+        operands += [0] * (2 - len(operands))
+        self.nodes += _NODE.pack(tag, flags, len(refs), operands[0], operands[1])
+        self.words.extend(refs)
+        self.words.extend(operands[2:])
+
+    def Bytes(self) -> bytes:
+        words, offsets = self.words, self.offsets
+        if sys.byteorder != "little":
+            words, offsets = array("I", words), array("I", offsets)
+            words.byteswap()
+            offsets.byteswap()
+        header = _HEADER.pack(
+            _MAGIC,
+            _VERSION,
+            len(self.nodes) // _NODE.size,
+            len(self.words),
+            len(self.offsets) - 1,
+            0,
+        )
+        return b"".join(
+            [header, self.nodes, words.tobytes(), offsets.tobytes(), self.pool]
+        )
+
+
+def _References(block: LayoutBlock) -> List[LayoutBlock]:
+    """ The blocks which the record of block refers to: its children, and joiner. """
+    joiner = getattr(block, "joiner", None)
+    if isinstance(joiner, LayoutBlock):
+        return block.Children() + [joiner]
+    return block.Children()
+
+
+def _EncodeContainer(writer: _Writer, strings: Container[str]) -> Tuple[int, bool]:
+    """The string encoding a container of strings, and if it is a set.
+
+    A set (or other collection) of strings is encoded as its strings, each
+    followed by a NUL.
+    """
+    if isinstance(strings, str):
+        return writer.String(strings), False
+    if not isinstance(strings, (set, frozenset, list, tuple)) or not all(
+        isinstance(s, str) and "\0" not in s for s in strings
+    ):
+        raise TypeError(f"{strings!r} is not a collection of strings")
+    return writer.String("".join(s + "\0" for s in sorted(set(strings)))), True
+
+
+def _Encode(writer: _Writer, block: LayoutBlock) -> Tuple[int, List[int]]:
+    """The flags and operands of the record of block.
+
+    The operands of each class of block are: TextBlock, the text; VerbBlock,
+    none (its lines take the place of children); StackBlock, break_mult;
+    WrapBlock, sep, prefix and break_mult; JoinedLineBlock, the joiner (if a
+    string); _ConditionalJoinedLineBlock, the joiner, no_space_left and
+    no_space_right; _JoinedStackBlock, the joiner (if a string) and break_mult;
+    and _WrapIfLongBlock, sep, prefix, wrap_len and break_mult. Strings are
+    given by their index in the string table, and floats take two words.
+    """
+    flags = _BREAKING if block.is_breaking else 0
+    operands: List[int] = []
+    if isinstance(block, TextBlock):
+        operands.append(writer.String(block.text))
+    elif isinstance(block, VerbBlock):
+        flags |= _FIRST_NL if block.first_nl else 0
+    elif isinstance(block, (WrapBlock, _WrapIfLongBlock)):
+        operands += [writer.String(block.sep), writer.String(block.prefix)]
+        if isinstance(block, _WrapIfLongBlock):
+            operands.append(block.wrap_len)
+    elif isinstance(block, (JoinedLineBlock, _JoinedStackBlock)):
+        if isinstance(block.joiner, LayoutBlock):
+            flags |= _JOINER_BLOCK
+            operands.append(0)
+        else:
+            operands.append(writer.String(block.joiner))
+        if isinstance(block, JoinedLineBlock) and block.join_breaking:
+            flags |= _JOIN_BREAKING
+    elif isinstance(block, _ConditionalJoinedLineBlock):
+        left, left_set = _EncodeContainer(writer, block.no_space_left)
+        right, right_set = _EncodeContainer(writer, block.no_space_right)
+        operands += [writer.String(block.joiner), left, right]
+        flags |= (_LEFT_SET if left_set else 0) | (_RIGHT_SET if right_set else 0)
+    if isinstance(block, (StackBlock, WrapBlock, _JoinedStackBlock, _WrapIfLongBlock)):
+        flags |= _INT_MULT if isinstance(block.break_mult, int) else 0
+        operands += _FLOAT_WORDS.unpack(_FLOAT.pack(block.break_mult))
+    return flags, operands
+
+
+def dump(block: LayoutBlock) -> bytes:
+    """Serialize a block tree in the binary format of this module.
+
+    Every block in the tree must be of one of the classes of blocks.py and
+    extras.py (though not a subclass of one), or TypeError is raised. Blocks
+    shared within the tree are stored once, and are shared again when loaded.
+    """
+    writer = _Writer()
+    # The indices in the node table of the blocks written, by id. The blocks
+    # are kept alive by the tree, so their ids are stable.
+    indices: Dict[int, int] = {}
+    # A post-order traversal, with an explicit stack so that deep trees don't
+    # exhaust the recursion limit.
+    stack: List[Tuple[LayoutBlock, bool]] = [(block, False)]
+    while stack:
+        node, children_done = stack.pop()
+        if id(node) in indices:
+            continue
+        tag = _TAGS.get(type(node))
+        if tag is None:
+            raise TypeError(f"{type(node).__name__} blocks can't be serialized")
+        references = _References(node)
+        if not children_done:
+            stack.append((node, True))
+            stack.extend(
+                (child, False)
+                for child in reversed(references)
+                if id(child) not in indices
+            )
+            continue
+        flags, operands = _Encode(writer, node)
+        if isinstance(node, VerbBlock):
+            refs = [writer.String(line) for line in node.lines]
+        else:
+            refs = [indices[id(child)] for child in references]
+        writer.Node(tag, flags, refs, operands)
+        indices[id(node)] = len(indices)
+    return writer.Bytes()
+
+
+def _Words(view: memoryview) -> Sequence[int]:
+    """ The little-endian 32-bit words of view (read in place, if native). """
+    if sys.byteorder == "little":
+        return view.cast("I")
+    words = array("I")
+    words.frombytes(view)
+    words.byteswap()
+    return words
+
+
+def load(data: Buffer) -> LayoutBlock:
+    """Load a block tree serialized by dump, returning its root.
+
+    data may be any bytes-like object, such as bytes or an mmap.mmap. Only the
+    reading happens in place (data isn't copied): the tree is built eagerly, so
+    every string is decoded and every block constructed before load returns,
+    and data isn't referred to afterwards. ValueError is raised if it isn't a
+    valid serialization.
+    """
+    with memoryview(data) as buffer, buffer.cast("B") as view:
+        if len(view) < _HEADER.size:
+            raise ValueError("Not a serialized block tree")
+        magic, version, n_nodes, n_words, n_strings, _ = _HEADER.unpack_from(view)
+        if magic != _MAGIC:
+            raise ValueError("Not a serialized block tree")
+        if version != _VERSION:
+            raise ValueError(f"Unsupported serialization version {version}")
+        words_start = _HEADER.size + n_nodes * _NODE.size
+        pool_start = words_start + 4 * (n_words + n_strings + 1)
+        if len(view) < pool_start:
+            raise ValueError("Truncated serialized block tree")
+        words = _Words(view[words_start:pool_start])
+        try:
+            return _Load(view, words, n_nodes, n_words, n_strings)
+        except (IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Corrupt serialized block tree: {e}") from None
+        finally:
+            if isinstance(words, memoryview):
+                words.release()
+
+
+def _Load(
+    view: memoryview, words: Sequence[int], n_nodes: int, n_words: int, n_strings: int
+) -> LayoutBlock:
+    """Build the tree serialized in view.
+
+    Args:
+      words: the words of the blocks' runs, then the string table.
+    """
+    words_start = _HEADER.size + n_nodes * _NODE.size
+    pool = view[words_start + 4 * (n_words + n_strings + 1) :]
+    offsets = words[n_words:]
+    if offsets[-1] != len(pool):
+        raise IndexError("string pool of the wrong length")
+    strings = [
+        str(pool[offsets[i] : offsets[i + 1]], "utf-8") for i in range(n_strings)
+    ]
+
+    def String(index: int) -> Optional[str]:
+        return None if index == _NONE else strings[index]
+
+    def Strings(index: int, is_set: int) -> Container[str]:
+        """ The container of strings encoded by _EncodeContainer. """
+        if is_set:
+            return frozenset(strings[index].split("\0")[:-1])
+        return strings[index]
+
+    def Mult(flags: int, low: int, high: int) -> float:
+        """ The break_mult encoded by _Encode, in a record with the given flags. """
+        value: float = _FLOAT.unpack(_FLOAT_WORDS.pack(low, high))[0]
+        return int(value) if flags & _INT_MULT else value
+
+    nodes: List[LayoutBlock] = []
+    start = 0
+    for tag, flags, count, a, b in _NODE.iter_unpack(view[_HEADER.size : words_start]):
+        if tag == 1:
+            # Texts, the commonest blocks, have neither children nor words.
+            nodes.append(TextBlock(strings[a], bool(flags & _BREAKING)))
+            continue
+        if not 0 < tag < len(_OPERANDS):
+            raise ValueError(f"Unknown block type tag {tag}")
+        end = start + count + _EXTRA_WORDS[tag]
+        if end > n_words:
+            raise IndexError("runs of words out of range")
+        refs, ops = words[start : start + count], [a, b, *words[start + count : end]]
+        start = end
+        if tag == 2:
+            nodes.append(
+                VerbBlock(
+                    [strings[i] for i in refs],
+                    is_breaking=bool(flags & _BREAKING),
+                    first_nl=bool(flags & _FIRST_NL),
+                )
+            )
+            continue
+        # Children come before their parents, so this is the only check needed
+        # that the references are valid.
+        elements = [nodes[i] for i in refs]
+        joiner: Union[str, LayoutBlock] = ""
+        if tag in (7, 9):
+            joiner = elements.pop() if flags & _JOINER_BLOCK else strings[a]
+        block: LayoutBlock
+        if tag == 3:
+            block = LineBlock(elements)
+        elif tag == 4:
+            block = ChoiceBlock(elements)
+        elif tag == 5:
+            block = StackBlock(elements, break_mult=Mult(flags, a, b))
+        elif tag == 6:
+            block = WrapBlock(
+                elements,
+                sep=strings[a],
+                break_mult=Mult(flags, *ops[2:]),
+                prefix=String(b),
+            )
+        elif tag == 7:
+            block = JoinedLineBlock(
+                elements, joiner=joiner, join_breaking=bool(flags & _JOIN_BREAKING)
+            )
+        elif tag == 8:
+            block = _ConditionalJoinedLineBlock(
+                elements,
+                joiner=strings[a],
+                no_space_left=Strings(b, flags & _LEFT_SET),
+                no_space_right=Strings(ops[2], flags & _RIGHT_SET),
+            )
+        elif tag == 9:
+            block = _JoinedStackBlock(
+                elements, joiner=joiner, break_mult=Mult(flags, *ops[1:])
+            )
+        else:
+            block = _WrapIfLongBlock(
+                elements,
+                sep=strings[a],
+                break_mult=Mult(flags, *ops[3:]),
+                prefix=String(b),
+                wrap_len=ops[2],
+            )
+        nodes.append(block)
+    if start != n_words or not nodes:
+        raise IndexError("runs of words don't match the node table")
+    return nodes[-1]
@@ -17,7 +17,23 @@
 
 import math
 import typing
-from typing import IO, Callable, Iterable, List, Optional, Sequence, Tuple, Union, cast
+from array import array
+from bisect import bisect_right
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
+from weakref import WeakValueDictionary
 
 from typing_extensions import Protocol
 
@@ -30,6 +46,10 @@ if typing.TYPE_CHECKING:
 # below).
 INFINITY = float("inf")
 
+# A range of left margins, (lo, hi), where hi may be INFINITY.
+Margins = Tuple[int, Union[int, float]]
+ALL_MARGINS: Margins = (0, INFINITY)
+
 
 class ConsoleLike(Protocol):
     def String(self, s: str) -> None:
@@ -120,6 +140,87 @@ class Console(ConsoleLike):
         self._margins.pop()
 
 
+class BufferedConsole(Console):
+    """A Console that prints layouts without recursion, and buffers its output.
+
+    Console.PrintLayout recurses once per nested layout, which for long lines
+    (each element of which nests the rest of the line) may be as deep as the
+    document. This console interprets the layouts' instructions itself, with an
+    explicit stack, and collects its output in a buffer, which is written to
+    the output stream in one go when the layout has been printed (or on Flush).
+    The output is exactly the same as Console's. Lines prints a layout line by
+    line instead, generating each line once it is finished.
+    """
+
+    def __init__(self, outp: IO[str], m0: int, m1: int):
+        super().__init__(outp, m0, m1)
+        self._chunks: List[str] = []
+
+    def String(self, s: str) -> None:
+        self._chunks.append(s)
+        self._h_pos += len(s)
+
+    def PrintGuide(self, initial_newline: bool = True, m0_too: bool = True) -> None:
+        self.Flush()
+        super().PrintGuide(initial_newline, m0_too)
+
+    def Flush(self) -> None:
+        """ Write any buffered output to the output stream. """
+        if self._chunks:
+            self._outp.write("".join(self._chunks))
+            self._chunks = []
+
+    def PrintLayout(self, layout: "Layout") -> None:
+        self._outp.write("".join(line + "\n" for line in self.Lines(layout)))
+        self.Flush()
+
+    def Lines(self, layout: "Layout", final: bool = False) -> Iterator[str]:
+        """Print a layout, generating each line (without its newline) once ended.
+
+        The output of the unfinished last line stays in the buffer, unless final
+        is True, in which case it is generated too (so that the lines joined by
+        newlines are exactly the output), and the buffer is emptied.
+        """
+        line = self._chunks
+        append = line.append
+        margins = self._margins
+        h_pos = self._h_pos
+        margins.append(h_pos)
+        # The instructions remaining, for each layout being printed, and whether
+        # a margin was pushed for it.
+        stack = [iter(layout.elements)]
+        pushed = [True]
+        while stack:
+            for op, arg in stack[-1]:
+                if op == STRING:
+                    append(arg)
+                    h_pos += len(arg)
+                elif op == NEW_LINE or op == NEW_LINE_SPACE:
+                    if op == NEW_LINE:
+                        h_pos = margins[-1] if arg else 0
+                    else:
+                        h_pos = margins[-1] + arg
+                    self._h_pos = h_pos
+                    yield "".join(line)
+                    line.clear()
+                    append(" " * h_pos)
+                else:
+                    # Descend into a nested layout, resuming this one later.
+                    if op == PRINT_LAYOUT:
+                        margins.append(h_pos)
+                    stack.append(iter(arg.elements))
+                    pushed.append(op == PRINT_LAYOUT)
+                    break
+            else:
+                stack.pop()
+                if pushed.pop():
+                    margins.pop()
+        self._h_pos = h_pos
+        if final:
+            yield "".join(line)
+            line.clear()
+
+
 class PrintDescriptionConsole(ConsoleLike):
     """A console that produces a description of the output.
 
@@ -150,11 +251,42 @@ class PrintDescriptionConsole(ConsoleLike):
         return "".join(self.out)
 
 
+# The opcodes of layout instructions, which are (opcode, argument) pairs:
+#   STRING: print the argument (a string).
+#   NEW_LINE: start a new line, at the current margin if the argument is True.
+#   NEW_LINE_SPACE: start a new line, indented by the argument from the margin.
+#   PRINT_LAYOUT: push a margin at the current position, print the argument (a
+#     Layout) and pop the margin again.
+#   SEQUENCE: print the argument (a Layout), without changing the margin.
+STRING, NEW_LINE, NEW_LINE_SPACE, PRINT_LAYOUT, SEQUENCE = range(5)
+
+Instruction = Tuple[int, Any]
+
+
+# The tags of the keys of Layout.Stack and Layout.Beside compositions.
+STACK_KEY, BESIDE_KEY = "Stack", "Beside"
+
+
 class Layout:
-    """ An object containing a sequence of directives to the console. """
+    """An object containing a sequence of directives to the console.
+
+    The directives are instructions (see above). Layouts nest other layouts by
+    reference, rather than by copying their instructions, so composing layouts
+    takes time proportional to the number of layouts composed, and the
+    composites share their parts.
+
+    A Layout may carry a key: a hashable description of its instructions, such
+    that Layouts with equal keys print identically. Keyed Layouts can be
+    interned (see InternLayout). The keys of composite Layouts refer to their
+    (interned) parts by identity. Layouts without a key are only ever equal to
+    themselves.
+    """
+
+    __slots__ = ("elements", "key", "__weakref__")
 
-    def __init__(self, elements: List[Callable[[ConsoleLike], None]]):
+    def __init__(self, elements: Sequence[Instruction], key: Optional[Hashable] = None):
         self.elements = elements
+        self.key = key
 
     def __str__(self) -> str:
         pr_cons = PrintDescriptionConsole()
@@ -163,8 +295,23 @@ class Layout:
 
     def PrintOn(self, console: ConsoleLike) -> None:
         """ Have the console execute all directives in this object. """
-        for e in self.elements:
-            e(console)
+        for op, arg in self.elements:
+            if op == STRING:
+                console.String(arg)
+            elif op == NEW_LINE:
+                console.NewLine(arg)
+            elif op == NEW_LINE_SPACE:
+                console.NewLineSpace(arg)
+            elif op == PRINT_LAYOUT:
+                console.PrintLayout(arg)
+            else:
+                arg.PrintOn(console)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Layouts may nest more deeply than pickle can recurse, so they are
+        # pickled as a flat table (see _FlattenLayouts). The layout itself is
+        # the last entry.
+        return (_LoadLayout, (_FlattenLayouts([self])[0],))
 
     def __add__(self, layout: "Layout") -> "Layout":
         """Concatenate the directives in two layouts.
@@ -174,7 +321,7 @@ class Layout:
         Returns:
           A new Layout, which concatenates both.
         """
-        return self.__class__(self.elements + layout.elements)
+        return self.__class__(((SEQUENCE, self), (SEQUENCE, layout)))
 
     @staticmethod
     def Stack(layouts: Iterable["Layout"]) -> "Layout":
@@ -183,41 +330,236 @@ class Layout:
         Args:
           layouts: a sequence of Layout objects.
         Returns:
-          A new Layout, stacking the arguments.
+          A Layout, stacking the arguments.
         """
-        l_elts = []
-        for l in layouts:
-            for e in l.elements:
-                l_elts.append(e)
-            l_elts.append(LayoutElement.NewLine())
-        return Layout(l_elts[:-1])  # Drop the last NewLine()
+        layouts = [InternLayout(l) for l in layouts]
+        key = (STACK_KEY,) + tuple(map(id, layouts))
+        layout = _LAYOUTS.get(key)
+        if layout is None:
+            l_elts: List[Instruction] = []
+            for l in layouts:
+                l_elts.append((SEQUENCE, l))
+                l_elts.append(LayoutElement.NewLine())
+            # Drop the last NewLine()
+            layout = _LAYOUTS[key] = Layout(l_elts[:-1], key=key)
+        return layout
+
+    @staticmethod
+    def Beside(left: "Layout", right: "Layout") -> "Layout":
+        """Return the horizontal composition of two layouts.
+
+        Args:
+          left, right: Layout objects.
+        Returns:
+          A Layout printing right at the end of the last line printed for left,
+          with its margin set there.
+        """
+        left, right = InternLayout(left), InternLayout(right)
+        key = (BESIDE_KEY, id(left), id(right))
+        layout = _LAYOUTS.get(key)
+        if layout is None:
+            layout = _LAYOUTS[key] = Layout(
+                (LayoutElement.PrintLayout(left), LayoutElement.PrintLayout(right)),
+                key=key,
+            )
+        return layout
 
 
 class LayoutElement:
     """An element of a layout object---a directive to the console.
 
     This class sports a collection of static methods, each of which returns
-    an anonymous function invoking a method of the console to which it is
-    applied.
+    an instruction invoking a method of the console to which it is applied.
     Refer to the corresponding methods of the Console class for descriptions of
     the methods involved.
     """
 
     @staticmethod
-    def String(s: str) -> Callable[[ConsoleLike], None]:
-        return lambda console: console.String(s)
+    def String(s: str) -> Instruction:
+        return (STRING, s)
 
     @staticmethod
-    def NewLine(indent: bool = True) -> Callable[[ConsoleLike], None]:
-        return lambda console: console.NewLine(indent)
+    def NewLine(indent: bool = True) -> Instruction:
+        return (NEW_LINE, indent)
 
     @staticmethod
-    def NewLineSpace(n: int) -> Callable[[ConsoleLike], None]:
-        return lambda console: console.NewLineSpace(n)
+    def NewLineSpace(n: int) -> Instruction:
+        return (NEW_LINE_SPACE, n)
 
     @staticmethod
-    def PrintLayout(layout: Layout) -> Callable[[ConsoleLike], None]:
-        return lambda console: console.PrintLayout(layout)
+    def PrintLayout(layout: Layout) -> Instruction:
+        return (PRINT_LAYOUT, layout)
+
+
+# The canonical Layouts and Solutions, keyed on their content. The tables hold
+# their entries weakly, so that interning doesn't keep anything alive. Note that
+# any ids in the keys are those of components referred to by the entries
+# themselves (a composite Layout's instructions refer to its parts), so they
+# remain valid for the lifetime of the entries.
+_LAYOUTS: "WeakValueDictionary[Hashable, Layout]" = WeakValueDictionary()
+_SOLUTIONS: "WeakValueDictionary[Hashable, Solution]" = WeakValueDictionary()
+
+
+def InternLayout(layout: Layout) -> Layout:
+    """ Return the canonical Layout with the same key as layout. """
+    if layout.key is None:
+        return layout
+    return _LAYOUTS.setdefault(layout.key, layout)
+
+
+def _IsPart(op: int) -> bool:
+    """ Whether the argument of an instruction is a (nested) Layout. """
+    return op == PRINT_LAYOUT or op == SEQUENCE
+
+
+def _FlattenLayouts(
+    roots: Sequence[Layout],
+) -> Tuple[List[Tuple[Hashable, List[Instruction]]], List[int]]:
+    """Describe the Layouts reachable from roots as a table, for pickling.
+
+    Each entry of the table holds a Layout's key and its instructions, in which
+    nested Layouts are replaced by the indices of their entries; parts come
+    before the Layouts containing them. The keys of Stack and Beside layouts,
+    which refer to their parts by (process-specific) identity, are replaced by
+    their tags. Returns the table, and the indices of the roots' entries.
+    """
+    index: Dict[int, int] = {}
+    table: List[Tuple[Hashable, List[Instruction]]] = []
+    stack = [(layout, False) for layout in reversed(roots)]
+    while stack:
+        layout, parts_done = stack.pop()
+        if id(layout) in index:
+            continue
+        if not parts_done:
+            stack.append((layout, True))
+            stack.extend(
+                (arg, False)
+                for op, arg in reversed(layout.elements)
+                if _IsPart(op) and id(arg) not in index
+            )
+            continue
+        index[id(layout)] = len(table)
+        key = layout.key
+        if isinstance(key, tuple) and key and key[0] in (STACK_KEY, BESIDE_KEY):
+            key = key[:1]
+        table.append(
+            (
+                key,
+                [
+                    (op, index[id(arg)]) if _IsPart(op) else (op, arg)
+                    for op, arg in layout.elements
+                ],
+            )
+        )
+    return table, [index[id(layout)] for layout in roots]
+
+
+def _LoadLayouts(table: List[Tuple[Hashable, List[Instruction]]]) -> List[Layout]:
+    """ Rebuild (and intern) the Layouts of a table made by _FlattenLayouts. """
+    layouts: List[Layout] = []
+    for key, elements in table:
+        elements = [
+            (op, layouts[arg]) if _IsPart(op) else (op, arg) for op, arg in elements
+        ]
+        if isinstance(key, tuple) and key in ((STACK_KEY,), (BESIDE_KEY,)):
+            key += tuple(id(arg) for op, arg in elements if _IsPart(op))
+        layouts.append(InternLayout(Layout(elements, key)))
+    return layouts
+
+
+def _LoadLayout(table: List[Tuple[Hashable, List[Instruction]]]) -> Layout:
+    return _LoadLayouts(table)[-1]
+
+
+# With Options.lazy_layouts, HPlusSolution and VSumSolution don't build the
+# Layouts for the knots of their results, but record where they would be
+# built from, in one of the following back-pointers:
+#   (BESIDE, s1, i1, s2, i2): Layout.Beside of the layouts for knot i1 of
+#     Solution s1 and knot i2 of Solution s2.
+#   (STACK, solutions, indices): Layout.Stack of the layouts for knot
+#     indices[j] of Solution solutions[j], for each j.
+# The Layouts are only built (by Solution.LayoutAt) for the knots which are
+# actually printed.
+BESIDE, STACK = range(2)
+
+LayoutRef = Tuple[Any, ...]
+
+
+def _LayoutIdentity(entry: Union[Layout, LayoutRef]) -> Hashable:
+    """ Identifies the layout entry of a Solution, for Solution.ContentKey. """
+    if isinstance(entry, Layout):
+        return id(entry)
+    if entry[0] == BESIDE:
+        return (BESIDE, id(entry[1]), entry[2], id(entry[3]), entry[4])
+    return (STACK, tuple(map(id, entry[1])), entry[2])
+
+
+def _Materialize(entry: Union[Layout, LayoutRef]) -> Layout:
+    """ Build the Layout to which a layout entry of a Solution refers. """
+    if isinstance(entry, Layout):
+        return entry
+    # The back-pointers may be nested as deeply as the document, so they are
+    # resolved in post-order with an explicit stack.
+    built: Dict[int, Layout] = {}
+    stack = [(entry, False)]
+    while stack:
+        ref, parts_done = stack.pop()
+        if id(ref) in built:
+            continue
+        if ref[0] == BESIDE:
+            parts = [ref[1].layouts[ref[2]], ref[3].layouts[ref[4]]]
+        else:
+            parts = [s.layouts[i] for s, i in zip(ref[1], ref[2])]
+        if not parts_done:
+            stack.append((ref, True))
+            stack.extend(
+                (p, False)
+                for p in parts
+                if not isinstance(p, Layout) and id(p) not in built
+            )
+            continue
+        layouts = [p if isinstance(p, Layout) else built[id(p)] for p in parts]
+        if ref[0] == BESIDE:
+            built[id(ref)] = Layout.Beside(*layouts)
+        else:
+            built[id(ref)] = Layout.Stack(layouts)
+    return built[id(entry)]
+
+
+def InternSolution(soln: "Solution") -> "Solution":
+    """Return the canonical Solution with the same content as soln.
+
+    Solutions built separately but with equal knots, costs and layouts are
+    thereby represented by a single object, so that they hit the same entries
+    in the blocks' layout caches (which are keyed on continuation identity).
+    """
+    if soln.interned:
+        return soln
+    soln.layouts = [
+        InternLayout(l) if isinstance(l, Layout) else l for l in soln.layouts
+    ]
+    canonical = _SOLUTIONS.setdefault(soln.ContentKey(), soln)
+    canonical.interned = True
+    return canonical
+
+
+def _IntArray(values: Iterable[int]) -> "array[int]":
+    """ Coerce values to an integer array, sharing it if it is one already. """
+    if isinstance(values, array) and values.typecode == "q":
+        return values
+    return array("q", map(int, values))
+
+
+def _FloatArray(values: Iterable[float]) -> "array[float]":
+    """ Coerce values to a float array, sharing it if it is one already. """
+    if isinstance(values, array) and values.typecode == "d":
+        return values
+    return array("d", map(float, values))
+
+
+def _IndexAt(knots: "array[int]", m: int) -> int:
+    """ The index of the knot at or immediately to the left of margin m. """
+    return bisect_right(knots, m) - 1
 
 
 class Solution:
@@ -230,37 +572,92 @@ class Solution:
     layouts.
 
     A Solution comprises five variables:
-      knots - a list of ints, specifying the margin settings at which the layout
-        changes. Note that the first knot is required to be 0.
-      spans - a list of ints, giving for each knot, the width of the corresponding
-        layout in characters.
-      intercepts - list of floats; constant cost associated with each knot.
-      gradients - list of flots; at each knot, the rate with which the layout cost
-        increases with an additional margin indent of 1 character.
+      knots - an array of ints, specifying the margin settings at which the
+        layout changes. Note that the first knot is required to be 0.
+      spans - an array of ints, giving for each knot, the width of the
+        corresponding layout in characters.
+      intercepts - array of floats; constant cost associated with each knot.
+      gradients - array of floats; at each knot, the rate with which the layout
+        cost increases with an additional margin indent of 1 character.
       layouts - the Layout objects expressing the optimal layout between
-        each knot.
+        each knot, or back-pointers from which they may be built (see
+        Options.lazy_layouts and LayoutAt).
       options - an options object for configuring layout parameters/costs/etc
 
+    The numeric tables are stored as typed arrays rather than lists of boxed
+    numbers. Arrays passed to the constructor are shared, not copied, so a
+    Solution (and its tables) must be treated as immutable once built.
+
+    Solutions produced by the combinators below are interned (see
+    InternSolution), in which case the interned flag is set.
+
     In addition to these items of data, a Solution object also facilitates
     iteration through the knots and the associated spans, intercepts, etc.
     """
 
+    __slots__ = (
+        "knots",
+        "spans",
+        "intercepts",
+        "gradients",
+        "layouts",
+        "index",
+        "options",
+        "interned",
+        "__weakref__",
+    )
+
     def __init__(
         self,
         knots: Iterable[int],
         spans: Iterable[int],
         intercepts: Iterable[float],
         gradients: Iterable[float],
-        layouts: List[Layout],
+        layouts: List[Union[Layout, LayoutRef]],
         options: "Options",
     ) -> None:
-        self.knots = list(map(int, knots))
-        self.spans = list(map(int, spans))
-        self.intercepts = list(map(float, intercepts))
-        self.gradients = list(map(float, gradients))
+        self.knots = _IntArray(knots)
+        self.spans = _IntArray(spans)
+        self.intercepts = _FloatArray(intercepts)
+        self.gradients = _FloatArray(gradients)
         self.layouts = layouts
         self.index = 0
         self.options = options
+        self.interned = False
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Lazy layouts are built, and the Layouts are pickled as one flat table
+        # (see _FlattenLayouts).
+        table, roots = _FlattenLayouts(
+            list(map(self.LayoutAt, range(len(self.layouts))))
+        )
+        return (
+            _LoadSolution,
+            (
+                self.knots,
+                self.spans,
+                self.intercepts,
+                self.gradients,
+                table,
+                roots,
+                self.options,
+            ),
+        )
+
+    def ContentKey(self) -> Hashable:
+        """A key identifying the cost function and layouts of this Solution.
+
+        Layouts are identified by identity, so the key is only meaningful for
+        Solutions whose layouts have been interned.
+        """
+        return (
+            self.options.Fingerprint(),
+            self.knots.tobytes(),
+            self.spans.tobytes(),
+            self.intercepts.tobytes(),
+            self.gradients.tobytes(),
+            tuple(map(_LayoutIdentity, self.layouts)),
+        )
 
     def __repr__(self) -> str:
         def KnotRepr(elts: Tuple[int, int, float, float, Layout]) -> str:
@@ -277,7 +674,7 @@ class Solution:
                             self.spans,
                             self.intercepts,
                             self.gradients,
-                            self.layouts,
+                            map(self.LayoutAt, range(len(self.layouts))),
                         )
                     ),
                 )
@@ -311,7 +708,11 @@ class Solution:
         return self.gradients[self.index]
 
     def CurLayout(self) -> Layout:
-        return self.layouts[self.index]
+        return self.LayoutAt(self.index)
+
+    def LayoutAt(self, index: int) -> Layout:
+        """ The layout for a knot, built from back-pointers if need be. """
+        return _Materialize(self.layouts[index])
 
     def CurIndex(self) -> int:
         return self.index
@@ -331,30 +732,32 @@ class Solution:
 
     def MoveToMargin(self, m: int) -> None:
         """ Adjust the index so m falls between the current knot and the next. """
-        if self.CurKnot() > m:
-            while self.CurKnot() > m:
-                self.Retreat()
-        else:
-            while self.NextKnot() <= m:
-                self.Advance()
+        self.index = _IndexAt(self.knots, m)
 
     def PlusConst(self, const: float) -> "Solution":
         """ Add a constant to all values of this Solution. """
-        return self.__class__(
-            self.knots,
-            self.spans,
-            [a + const for a in self.intercepts],
-            self.gradients,
-            self.layouts,
-            options=self.options,
+        # Only the intercepts change; the other tables are shared.
+        return InternSolution(
+            self.__class__(
+                self.knots,
+                self.spans,
+                array("d", [a + const for a in self.intercepts]),
+                self.gradients,
+                self.layouts,
+                options=self.options,
+            )
         )
 
-    def WithRestOfLine(self, rest_of_line: Optional["Solution"]) -> "Solution":
+    def WithRestOfLine(
+        self, rest_of_line: Optional["Solution"], margins: Margins = ALL_MARGINS
+    ) -> "Solution":
         """Return a Solution that joins the rest of the line right of this one.
 
         Args:
           rest_of_line: a Solution object representing the code laid out on the
             remainder of the line, or None, if the rest of the line is empty.
+          margins: the range of margins for which the Solution is needed (see
+            HPlusSolution).
         Returns:
           A new Solution object juxtaposing the layout represented by this
           Solution to the immediate right of the remainder of the line.
@@ -362,32 +765,69 @@ class Solution:
         return (
             self
             if rest_of_line is None
-            else HPlusSolution(self, rest_of_line, self.options)
+            else HPlusSolution(self, rest_of_line, self.options, margins)
         )
 
 
+def _LoadSolution(
+    knots: "array[int]",
+    spans: "array[int]",
+    intercepts: "array[float]",
+    gradients: "array[float]",
+    table: List[Tuple[Hashable, List[Instruction]]],
+    roots: List[int],
+    options: "Options",
+) -> Solution:
+    """ Rebuild (and intern) a Solution pickled by Solution.__reduce__. """
+    layouts = _LoadLayouts(table)
+    return InternSolution(
+        Solution(
+            knots,
+            spans,
+            intercepts,
+            gradients,
+            [layouts[i] for i in roots],
+            options,
+        )
+    )
+
+
 class SolutionFactory:
     """A factory object used to construct new Solution objects.
 
     The factory performs basic consistency checks, and eliminates redundant
     segments that are linear extrapolations of those that precede them.
+    Segments are accumulated directly into the typed arrays of the Solution.
+    A Solution built only for the margins from some knot on (see Margins) is
+    given a first, flat, segment, standing in for the margins before it.
     """
 
     def __init__(self) -> None:
-        self.entries: List[Tuple[int, int, float, float, Layout]] = []
+        self.knots: "array[int]" = array("q")
+        self.spans: "array[int]" = array("q")
+        self.intercepts: "array[float]" = array("d")
+        self.gradients: "array[float]" = array("d")
+        self.layouts: List[Union[Layout, LayoutRef]] = []
 
     def Append(
-        self, knot: int, span: int, intercept: float, gradient: float, layout: Layout
+        self,
+        knot: int,
+        span: int,
+        intercept: float,
+        gradient: float,
+        layout: Union[Layout, LayoutRef],
     ) -> None:
         """ Add a segment to a Solution under construction. """
-        if self.entries:
+        if not self.knots and knot > 0:
+            self.Append(0, span, intercept, 0.0, layout)
+        if self.knots:
             # Don't add a knot if the new segment is a linear extrapolation of
             # the last.
-            k_last, s_last, i_last, g_last, _ = self.entries[-1]
+            g_last = self.gradients[-1]
             if (
-                span == s_last
+                span == self.spans[-1]
                 and gradient == g_last
-                and i_last + (knot - k_last) * g_last == intercept
+                and self.intercepts[-1] + (knot - self.knots[-1]) * g_last == intercept
             ):
                 return
         if knot < 0 or span < 0 or intercept < 0 or gradient < 0:
@@ -395,19 +835,120 @@ class SolutionFactory:
                 ("Internal error: bad layout" "(k %d, s %d, i %f, g %f)")
                 % (knot, span, intercept, gradient)
             )
-        self.entries.append((knot, span, intercept, gradient, layout))
+        self.knots.append(int(knot))
+        self.spans.append(int(span))
+        self.intercepts.append(intercept)
+        self.gradients.append(gradient)
+        self.layouts.append(layout)
 
     def MkSolution(self, options: "Options") -> Solution:
-        """ Construct and return a new Solution with the data in this object. """
-        return Solution(*list(zip(*self.entries)), options=options)  # type: ignore
+        """Construct and return a new Solution with the data in this object.
 
+        With options.knot_tolerance or options.max_knots, the Solution is an
+        approximation, with fewer knots (see _MergePieces).
+        """
+        if options.knot_tolerance or (
+            options.max_knots is not None and len(self.knots) > options.max_knots
+        ):
+            merged = _MergePieces(self, options.knot_tolerance, options.max_knots)
+            if len(merged.knots) < len(self.knots):
+                return merged.MkSolution(options)
+        return Solution(
+            self.knots,
+            self.spans,
+            self.intercepts,
+            self.gradients,
+            self.layouts,
+            options=options,
+        )
+
+
+def _MergePass(
+    factory: SolutionFactory, tolerance: float
+) -> Tuple[SolutionFactory, float]:
+    """Merge runs of consecutive pieces of a cost function, if close enough.
 
-def HPlusSolution(s1: Solution, s2: Solution, options: "Options") -> Solution:
+    Each run is replaced by a single piece, with the layout of its first piece,
+    and the least linear cost which is no less than the cost of any piece of the
+    run, at any margin, with a gradient no less than theirs. (Combinators such
+    as HPlusSolution rely on the gradients including the costs of overhanging
+    the margins.) The approximate cost is thus an upper bound on the exact one,
+    by at most tolerance at every margin of the run (so the last piece is only
+    merged into a run with the same gradient).
+
+    Returns:
+      A factory holding the merged pieces, and the least excess cost which
+      stopped a run being extended (INFINITY if none was).
+    """
+    knots, intercepts, gradients = factory.knots, factory.intercepts, factory.gradients
+    spans, layouts = factory.spans, factory.layouts
+    n = len(knots)
+    merged = SolutionFactory()
+    least_excess = INFINITY
+    # The run: its first piece, its cost (c + g * (m - knots[first])), and an
+    # upper bound on its excess over the exact cost.
+    first, c, g, excess = 0, intercepts[0], gradients[0], 0.0
+    for j in range(1, n + 1):
+        if j < n:
+            k = knots[j]
+            new_g = max(g, gradients[j])
+            new_c = max(c, intercepts[j] - new_g * (k - knots[first]))
+            # Raising the cost of the run raises its excess over earlier pieces
+            # by at most the rise at k.
+            rise = new_c + new_g * (k - knots[first]) - (c + g * (k - knots[first]))
+            if j + 1 < n:
+                end = knots[j + 1] - 1
+                end_excess = (
+                    new_c
+                    + new_g * (end - knots[first])
+                    - intercepts[j]
+                    - gradients[j] * (end - k)
+                )
+            else:
+                end_excess = 0.0 if new_g == gradients[j] else INFINITY
+            start_excess = new_c + new_g * (k - knots[first]) - intercepts[j]
+            new_excess = max(excess + rise, start_excess, end_excess)
+            if new_excess <= tolerance:
+                c, g, excess = new_c, new_g, new_excess
+                continue
+            least_excess = min(least_excess, new_excess)
+        merged.Append(knots[first], spans[first], c, g, layouts[first])
+        if j < n:
+            first, c, g, excess = j, intercepts[j], gradients[j], 0.0
+    return merged, least_excess
+
+
+def _MergePieces(
+    factory: SolutionFactory, tolerance: float, max_knots: Optional[int]
+) -> SolutionFactory:
+    """Approximate a cost function with fewer pieces.
+
+    The pieces are merged within tolerance (see _MergePass), and then with
+    tolerances doubling from the least excess cost that would merge more pieces,
+    until there are at most max_knots of them. Each pass takes linear time, so an
+    approximate Solution is built in O(n log(C)) for a range of costs C.
+    """
+    merged, least_excess = _MergePass(factory, tolerance)
+    while (
+        max_knots is not None
+        and len(merged.knots) > max_knots
+        and least_excess < INFINITY
+    ):
+        tolerance = max(2 * tolerance, least_excess)
+        merged, least_excess = _MergePass(factory, tolerance)
+    return merged
+
+
+def HPlusSolution(
+    s1: Solution, s2: Solution, options: "Options", margins: Margins = ALL_MARGINS
+) -> Solution:
     """The Solution that results from joining two Solutions side-by-side.
 
     Args:
       s1: Solution object
       s2: Solution object
+      margins: the range of margins for which the Solution is needed; it has no
+        knots outside this range.
     Returns:
       A new Solution reflecting a layout in which s2 ('s layout) is placed
       immediately to the right of s1.
@@ -420,143 +961,194 @@ def HPlusSolution(s1: Solution, s2: Solution, options: "Options") -> Solution:
     s2's layout begins at the end of the last line of s1's layout---the span
     in this case is the span of s1's last line.
     """
+    # Back-pointers identify the Solutions they point to by identity, so those
+    # had better be canonical.
+    if options.lazy_layouts:
+        s1, s2 = InternSolution(s1), InternSolution(s2)
+    # The knot tables are walked with local indices rather than the Solutions'
+    # own iteration protocol, so that s1 and s2 may be the same object.
+    k1, sp1, a1, g1 = s1.knots, s1.spans, s1.intercepts, s1.gradients
+    k2, sp2, a2, g2 = s2.knots, s2.spans, s2.intercepts, s2.gradients
+    l1, l2 = s1.layouts, s2.layouts
+    n1, n2 = len(k1), len(k2)
+    m0, m0_cost = options.margin_0, options.margin_0_cost
+    m1, m1_cost = options.margin_1, options.margin_1_cost
+    lazy = options.lazy_layouts
     col = SolutionFactory()
-    s1.Reset()
-    s2.Reset()
-    s1_margin: int = 0
-    s2_margin: int = s1.CurSpan()
-    s2.MoveToMargin(s2_margin)
-    while True:
+    lo, hi = margins
+    i1 = _IndexAt(k1, lo)
+    s1_margin: int = lo
+    s2_margin: int = lo + sp1[i1]
+    i2 = _IndexAt(k2, s2_margin)
+    while s1_margin <= hi:
         # When forming the composite cost gradient and intercept, we must
         # eliminate the over-counting of the last line of the s1, which is
         # attributable to its projection beyond the margins.
-        g1 = s1.CurGradient()
-        g2 = s2.CurGradient()
-        overhang0 = s2_margin - options.margin_0  # s2_margin = m1 + span of s1
-        overhang1 = s2_margin - options.margin_1  # s2_margin = m1 + span of s1
+        overhang0 = s2_margin - m0  # s2_margin = m1 + span of s1
+        overhang1 = s2_margin - m1  # s2_margin = m1 + span of s1
         g_cur = (
-            g1
-            + g2
-            - options.margin_0_cost * (overhang0 >= 0)
-            - options.margin_1_cost * (overhang1 >= 0)
+            g1[i1] + g2[i2] - m0_cost * (overhang0 >= 0) - m1_cost * (overhang1 >= 0)
         )
         i_cur = (
-            s1.CurValueAt(s1_margin)
-            + s2.CurValueAt(s2_margin)
-            - options.margin_0_cost * max(overhang0, 0)
-            - options.margin_1_cost * max(overhang1, 0)
+            (a1[i1] + g1[i1] * (s1_margin - k1[i1]))
+            + (a2[i2] + g2[i2] * (s2_margin - k2[i2]))
+            - m0_cost * max(overhang0, 0)
+            - m1_cost * max(overhang1, 0)
         )
+        # With options.restrict_margins, s2 may only be valid for a range of
+        # margins (see RestrictSolution), and be extrapolated at s2_margin, so
+        # that it costs less than the overhang taken off. s2 is never placed at
+        # such margins (it is the continuation of s1 only at those in its range),
+        # but the layouts there must still be well-formed.
+        g_cur, i_cur = max(g_cur, 0.0), max(i_cur, 0.0)
         # The Layout computed by the following implicitly sets the margin
         # for s2 at the end of the last line printed for s1.
         col.Append(
             s1_margin,
-            s1.CurSpan() + s2.CurSpan(),
+            sp1[i1] + sp2[i2],
             i_cur,
             g_cur,
-            Layout(
-                [
-                    LayoutElement.PrintLayout(s1.CurLayout()),
-                    LayoutElement.PrintLayout(s2.CurLayout()),
-                ]
-            ),
+            (BESIDE, s1, i1, s2, i2)
+            if lazy
+            else Layout.Beside(_Materialize(l1[i1]), _Materialize(l2[i2])),
         )
         # Move to the knot closest to the margin of the corresponding
         # component.
-        kn1 = s1.NextKnot()
-        kn2 = s2.NextKnot()
+        kn1 = k1[i1 + 1] if i1 + 1 < n1 else INFINITY
+        kn2 = k2[i2 + 1] if i2 + 1 < n2 else INFINITY
         if kn1 == INFINITY and kn2 == INFINITY:
             break
         # Note in the following that one of kn1 or kn2 may be infinite.
         if kn1 - s1_margin <= kn2 - s2_margin:
-            s1.Advance()
+            i1 += 1
             s1_margin = cast(int, kn1)
-            s2_margin = s1_margin + s1.CurSpan()
-            # Note that s1.CurSpan() may have changed, and s2_margin may
+            s2_margin = s1_margin + sp1[i1]
+            # Note that s1's span may have changed, and s2_margin may
             # decrease, so we cannot simply increment s2's index.
-            s2.MoveToMargin(s2_margin)
+            i2 = _IndexAt(k2, s2_margin)
         else:
-            s2.Advance()
+            i2 += 1
             s2_margin = cast(int, kn2)
-            s1_margin = s2_margin - s1.CurSpan()
-    return col.MkSolution(options)
+            s1_margin = s2_margin - sp1[i1]
+    return InternSolution(col.MkSolution(options))
 
 
-def VSumSolution(solutions: Sequence[Solution], options: "Options") -> Solution:
+def VSumSolution(
+    solutions: Sequence[Solution], options: "Options", margins: Margins = ALL_MARGINS
+) -> Solution:
     """The layout that results from stacking several Solutions vertically.
 
     Args:
       solutions: a non-empty sequence of Solution objects
+      margins: the range of margins for which the Solution is needed; it has no
+        knots outside this range.
     Returns:
       A Solution object that lays out the solutions vertically, separated by
       newlines, with the same left margin.
     """
     if len(solutions) == 1:
-        return solutions[0]
+        return InternSolution(solutions[0])
+    if options.lazy_layouts:
+        solutions = [InternSolution(s) for s in solutions]
     col = SolutionFactory()
-    for s in solutions:
-        s.Reset()
-    margin = 0  # Margin for all components
-    while True:
+    n = len(solutions)
+    knots = [s.knots for s in solutions]
+    intercepts = [s.intercepts for s in solutions]
+    gradients = [s.gradients for s in solutions]
+    layouts = [s.layouts for s in solutions]
+    lazy = options.lazy_layouts
+    last_spans = solutions[-1].spans
+    margin, hi = margins  # Margin for all components
+    index = [_IndexAt(knots[i], margin) for i in range(n)]
+    while margin <= hi:
         col.Append(
             margin,
-            solutions[-1].CurSpan(),
-            sum(s.CurValueAt(margin) for s in solutions),
-            sum(s.CurGradient() for s in solutions),
-            Layout.Stack(s.CurLayout() for s in solutions),
+            last_spans[index[-1]],
+            sum(
+                intercepts[i][index[i]]
+                + gradients[i][index[i]] * (margin - knots[i][index[i]])
+                for i in range(n)
+            ),
+            sum(gradients[i][index[i]] for i in range(n)),
+            (STACK, solutions, tuple(index))
+            if lazy
+            else Layout.Stack(_Materialize(layouts[i][index[i]]) for i in range(n)),
         )
         # The distance to the closest next knot from the current margin.
         d_star = min(
-            s.NextKnot() - margin for s in solutions if s.NextKnot() > margin
-        )  # TODO(pyelland): Redundant check?
+            knots[i][index[i] + 1] - margin
+            if index[i] + 1 < len(knots[i])
+            else INFINITY
+            for i in range(n)
+        )
         if d_star == INFINITY:
             break
         margin += cast(int, d_star)
-        for s in solutions:
-            s.MoveToMargin(margin)
-    return col.MkSolution(options)
+        for i in range(n):
+            while index[i] + 1 < len(knots[i]) and knots[i][index[i] + 1] <= margin:
+                index[i] += 1
+    return InternSolution(col.MkSolution(options))
 
 
-def MinSolution(solutions: Sequence[Solution], options: "Options") -> Solution:
+def MinSolution(
+    solutions: Sequence[Solution], options: "Options", margins: Margins = ALL_MARGINS
+) -> Solution:
     """Form the piecewise minimum of a sequence of Solutions.
 
     Args:
       solutions: a non-empty sequence of Solution objects
+      margins: the range of margins for which the Solution is needed; it has no
+        knots outside this range.
     Returns:
       values Solution object whose cost is the piecewise minimum of the Solutions
       provided, and which associates the minimum-cost layout with each piece.
     """
     if len(solutions) == 1:
-        return solutions[0]
+        return InternSolution(solutions[0])
+    if options.vectorize:
+        return RestrictSolution(VectorizedMinSolution(solutions, options), margins)
     factory = SolutionFactory()
-    for s in solutions:
-        s.Reset()
     n = len(solutions)
-    k_l = 0
+    knots = [s.knots for s in solutions]
+    intercepts = [s.intercepts for s in solutions]
+    all_gradients = [s.gradients for s in solutions]
+    k_l, hi = margins
+    index = [_IndexAt(knots[i], k_l) for i in range(n)]
     last_i_min_soln = -1  # Index of the last minimum solution
     last_index = -1  # Index of the current knot in the last minimum solution
     # Move through the intervals [k_l, k_h] defined by the glb of the partitions
     # defined by each of the solutions.
-    while k_l < INFINITY:
-        k_h = min(s.NextKnot() for s in solutions) - 1
-        gradients = [s.CurGradient() for s in solutions]
+    while k_l < INFINITY and k_l <= hi:
+        k_h = (
+            min(
+                knots[i][index[i] + 1] if index[i] + 1 < len(knots[i]) else INFINITY
+                for i in range(n)
+            )
+            - 1
+        )
+        gradients = [all_gradients[i][index[i]] for i in range(n)]
         while True:
-            values = [s.CurValueAt(k_l) for s in solutions]
+            values = [
+                intercepts[i][index[i]] + gradients[i] * (k_l - knots[i][index[i]])
+                for i in range(n)
+            ]
             # Use the index of the corresponding solution to break ties.
             min_value, min_gradient, i_min_soln = min(
                 (values[i], gradients[i], i) for i in range(n)
             )
-            min_soln = solutions[i_min_soln]
-            if i_min_soln != last_i_min_soln or min_soln.CurIndex() != last_index:
+            min_index = index[i_min_soln]
+            if i_min_soln != last_i_min_soln or min_index != last_index:
                 # Add another piece to the new Solution
+                min_soln = solutions[i_min_soln]
                 factory.Append(
                     k_l,
-                    min_soln.CurSpan(),
+                    min_soln.spans[min_index],
                     min_value,
                     min_gradient,
-                    min_soln.CurLayout(),
+                    min_soln.layouts[min_index],
                 )
                 last_i_min_soln = i_min_soln
-                last_index = min_soln.CurIndex()
+                last_index = min_index
             # It's possible that within the current interval, the minimum solution
             # may change, should a solution with a lower initial value but greater
             # gradient surpass the value of one with a higher initial value but
@@ -571,10 +1163,139 @@ def MinSolution(solutions: Sequence[Solution], options: "Options") -> Solution:
             crossovers = [k_l + d for d in distances_to_cross if k_l + d <= k_h]
             if crossovers:  # Proceed to crossover in [k_l, k_h]
                 k_l = min(crossovers)
+                if k_l > hi:
+                    break
             else:  # Proceed to next piece
                 k_l = cast(int, k_h) + 1
-                if k_l < INFINITY:
-                    for s in solutions:
-                        s.MoveToMargin(k_l)
+                if k_l < INFINITY and k_l <= hi:
+                    for i in range(n):
+                        index[i] = _IndexAt(knots[i], k_l)
+                break
+    return InternSolution(factory.MkSolution(options))
+
+
+def RestrictSolution(soln: Solution, margins: Margins) -> Solution:
+    """The Solution equal to soln at the margins in a range, with no knots outside.
+
+    Below the segment of soln at the start of the range, the Solution has a flat
+    segment (see SolutionFactory), and above the range, its last segment extends
+    that of soln at the end of the range.
+    """
+    lo, hi = margins
+    knots = soln.knots
+    first = _IndexAt(knots, lo)
+    end = bisect_right(knots, hi)
+    # Only a first segment before the range is left (as by the combinators).
+    if first <= 1 and end == len(knots):
+        return InternSolution(soln)
+    factory = SolutionFactory()
+    spans, intercepts, gradients = soln.spans, soln.intercepts, soln.gradients
+    layouts = soln.layouts
+    for i in range(first, end):
+        factory.Append(knots[i], spans[i], intercepts[i], gradients[i], layouts[i])
+    # The knots kept are exact, and no approximation (see MkSolution) is needed.
+    return InternSolution(
+        Solution(
+            factory.knots,
+            factory.spans,
+            factory.intercepts,
+            factory.gradients,
+            factory.layouts,
+            options=soln.options,
+        )
+    )
+
+
+def VectorizedMinSolution(
+    solutions: Sequence[Solution], options: "Options"
+) -> Solution:
+    """Form the piecewise minimum of a sequence of Solutions using NumPy.
+
+    This computes exactly the same Solution as MinSolution (including the choice
+    of layout where candidates tie), but evaluates all of the candidates at
+    once. The knots of every candidate are merged into a single grid, the
+    candidates' segments are looked up for every interval of the grid in one
+    batch, and the crossovers within an interval are found with array
+    operations rather than per-candidate Python loops. It pays off when there
+    are many candidates, as in large ChoiceBlocks and long WrapBlocks.
+
+    Args:
+      solutions: a non-empty sequence of Solution objects
+    Returns:
+      A Solution object whose cost is the piecewise minimum of the Solutions
+      provided, and which associates the minimum-cost layout with each piece.
+    """
+    try:
+        import numpy as np
+    except ImportError:
+        raise ImportError(
+            "Options.vectorize requires numpy: install format-blocks[vectorize]"
+        )
+
+    if len(solutions) == 1:
+        return solutions[0]
+    # The merged grid of knots; the intervals [grid[g], grid[g + 1] - 1] are the
+    # glb of the partitions defined by each of the solutions.
+    grid = np.unique(
+        np.concatenate([np.frombuffer(s.knots, np.int64) for s in solutions])
+    )
+    # For every candidate and every interval, the index of the applicable knot.
+    index = np.stack(
+        [
+            np.searchsorted(np.frombuffer(s.knots, np.int64), grid, side="right") - 1
+            for s in solutions
+        ]
+    )
+    knots = np.stack(
+        [np.frombuffer(s.knots, np.int64)[i] for s, i in zip(solutions, index)]
+    )
+    intercepts = np.stack(
+        [np.frombuffer(s.intercepts, np.float64)[i] for s, i in zip(solutions, index)]
+    )
+    gradients = np.stack(
+        [np.frombuffer(s.gradients, np.float64)[i] for s, i in zip(solutions, index)]
+    )
+    factory = SolutionFactory()
+    last_i_min_soln = -1  # Index of the last minimum solution
+    last_index = -1  # Index of the current knot in the last minimum solution
+    for g in range(len(grid)):
+        k_l = int(grid[g])
+        k_h = int(grid[g + 1]) - 1 if g + 1 < len(grid) else INFINITY
+        cur_knots = knots[:, g]
+        cur_intercepts = intercepts[:, g]
+        cur_gradients = gradients[:, g]
+        while True:
+            values = cur_intercepts + cur_gradients * (k_l - cur_knots)
+            # Break ties on value by gradient, then by the candidate's index.
+            min_value = values.min()
+            at_min = values == min_value
+            min_gradient = cur_gradients[at_min].min()
+            i_min_soln = int(
+                np.flatnonzero(at_min & (cur_gradients == min_gradient))[0]
+            )
+            min_index = int(index[i_min_soln, g])
+            if i_min_soln != last_i_min_soln or min_index != last_index:
+                min_soln = solutions[i_min_soln]
+                factory.Append(
+                    k_l,
+                    min_soln.spans[min_index],
+                    float(min_value),
+                    float(min_gradient),
+                    min_soln.layouts[min_index],
+                )
+                last_i_min_soln = i_min_soln
+                last_index = min_index
+            # Candidates with a lesser gradient may cross below the minimum
+            # within the interval, in which case we add an extra piece.
+            crossing = cur_gradients < min_gradient
+            if not crossing.any():
+                break
+            distances_to_cross = np.ceil(
+                (values[crossing] - min_value)
+                / (min_gradient - cur_gradients[crossing])
+            )
+            crossover = k_l + int(distances_to_cross.min())
+            if crossover > k_h:
                 break
+            k_l = crossover
     return factory.MkSolution(options)
@@ -15,17 +15,44 @@
 
 # type: ignore
 
+import dataclasses
+import gc
+import io
+import mmap
+import pickle
+import random
+import sys
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
 import pytest
 
 from format_blocks import (
+    BlockInterner,
     BlockUsageError,
     ChoiceBlock,
     JoinedLineBlock,
+    LayoutBlock,
     LineBlock,
     Options,
+    Profiler,
     StackBlock,
     TextBlock,
+    VerbBlock,
+    WrapBlock,
+    cache_stats,
+    support,
+)
+from format_blocks.blocks import _TEXT_COSTS, _TEXT_COSTS_SIZE, _BoundValueAt
+from format_blocks.extras import (
+    _ConditionalJoinedLineBlock,
+    _JoinedStackBlock,
+    _WrapIfLongBlock,
+    get_end_text,
+    get_start_text,
 )
+from format_blocks.parallel import FormatMany, SeedLayouts, SolveInParallel
+from format_blocks.serialization import dump, load
 
 OPTS = Options()
 
@@ -44,6 +71,61 @@ def test_joined_line_block() -> None:
     assert block.Render(OPTS) == "hello\nworld !"
 
 
+def test_joined_blocks_are_lowered_once():
+    elements = [TextBlock("a"), TextBlock("b")]
+    block = _JoinedStackBlock(elements, joiner=TextBlock(","))
+    lowered = block.Lowered()
+    assert block.Render(OPTS) == "a,\nb"
+    # The lines before the last don't depend on the continuation, so their
+    # layouts are reused.
+    cache_stats.Reset()
+    block.OptLayout(TextBlock(")").OptLayout(None, OPTS), OPTS)
+    assert block.Lowered() is lowered
+    assert cache_stats.hits == 1
+    block.ReplaceElement(1, TextBlock("c"))
+    assert block.Lowered() is not lowered
+    assert block.Render(OPTS) == "a,\nc"
+
+
+def test_conditional_join_uses_first_and_last_leaves():
+    call = LineBlock([TextBlock("f"), LineBlock([TextBlock("(x"), TextBlock(")")])])
+    block = _ConditionalJoinedLineBlock([call, TextBlock("."), TextBlock("y")])
+    assert call.FirstLeaf().text == "f" and call.LastLeaf().text == ")"
+    assert block.Render(OPTS) == "f(x).y"
+    # The leaves are kept up to date, and found without recursion.
+    deep = TextBlock("(")
+    for _ in range(5000):
+        deep = LineBlock([TextBlock("a"), deep])
+    block.ReplaceElement(1, deep)
+    assert block.LastLeaf().text == "y" and deep.LastLeaf().text == "("
+    assert get_start_text(deep) == "a" and get_end_text(block) == "y"
+    # No space is put between the "(" ending the chain and "y".
+    assert [len(ln.elements) for ln in block.CompositeLowered().elements] == [1, 2]
+
+
+def test_conditional_join_spacing():
+    # The joiner is left out after the last text of an element, at any depth,
+    # including the first element.
+    opening = LineBlock([TextBlock("g"), LineBlock([TextBlock("h"), TextBlock("(")])])
+    assert _ConditionalJoinedLineBlock([opening, TextBlock("z")]).Render(OPTS) == "gh(z"
+    nested = LineBlock([TextBlock("a"), LineBlock([TextBlock("b"), TextBlock(".")])])
+    block = _ConditionalJoinedLineBlock([TextBlock("x"), nested, TextBlock("c")])
+    assert block.Render(OPTS) == "x ab.c"
+
+
+def test_extended_blocks_share_elements():
+    blocks = [LineBlock([TextBlock("a")])]
+    for i in range(20000):
+        blocks.append(blocks[-1].extended([TextBlock(str(i % 10))]))
+    assert len(blocks[-1].elements) == 20001
+    # The blocks extended are unchanged, and may be extended again.
+    assert blocks[3].Render(OPTS) == "a012"
+    assert blocks[3].extended([TextBlock("x")]).Render(OPTS) == "a012x"
+    assert blocks[4].Render(OPTS) == "a0123"
+    wrap = WrapBlock([TextBlock("a")], sep=", ").extended([TextBlock("b")] * 3)
+    assert wrap.Render(Options(margin_1=7)) == "a, b, b\nb"
+
+
 def test_stack_block_basic():
     block = StackBlock([TextBlock("hello"), TextBlock("world"), TextBlock("!")])
     assert block.Render(OPTS) == "hello\nworld\n!"
@@ -72,3 +154,583 @@ def test_choice_block(options, expected):
 def test_composite_block_asserts_elements():
     with pytest.raises(BlockUsageError):
         LineBlock([])
+
+
+def test_hplus_solution_with_itself():
+    soln = TextBlock("ab").OptLayout(None, OPTS)
+    joined = support.HPlusSolution(soln, soln, OPTS)
+    expected = TextBlock("abab").OptLayout(None, OPTS)
+    for m in range(0, 100):
+        joined.MoveToMargin(m)
+        expected.MoveToMargin(m)
+        assert joined.CurSpan() == expected.CurSpan()
+        assert joined.CurValueAt(m) == pytest.approx(expected.CurValueAt(m))
+
+
+def _wrap_or_stack():
+    words = [TextBlock("x" * (1 + i * 7 % 11)) for i in range(40)]
+    return ChoiceBlock([WrapBlock(words, sep=", "), StackBlock(words)])
+
+
+@pytest.mark.parametrize(
+    "options", [Options(margin_0=10, margin_1=60), Options(margin_0=20, margin_1=30)]
+)
+def test_vectorized_min_solution(options):
+    pytest.importorskip("numpy")
+    expected = _wrap_or_stack().OptLayout(None, options)
+    vectorized = dataclasses.replace(options, vectorize=True)
+    assert repr(_wrap_or_stack().OptLayout(None, vectorized)) == repr(expected)
+
+
+def test_vectorize_without_numpy(monkeypatch):
+    monkeypatch.setitem(sys.modules, "numpy", None)
+    options = Options(vectorize=True)
+    with pytest.raises(ImportError, match=r"format-blocks\[vectorize\]"):
+        _wrap_or_stack().Render(options)
+
+
+def test_layout_cache_respects_options():
+    block = _wrap_or_stack()
+    narrow, wide = Options(margin_1=20), Options(margin_1=200)
+    assert block.Render(narrow) == _wrap_or_stack().Render(narrow)
+    assert block.Render(wide) == _wrap_or_stack().Render(wide)
+    assert block.Render(narrow) != block.Render(wide)
+
+
+def test_text_costs_are_bounded():
+    options = Options()
+    _TEXT_COSTS.clear()
+    for n in range(_TEXT_COSTS_SIZE + 10):
+        TextBlock("x" * n).OptLayout(None, options)
+    assert len(_TEXT_COSTS) == _TEXT_COSTS_SIZE
+    assert (options.Fingerprint(), 9) not in _TEXT_COSTS
+    # Texts of the same length share the costs, which are then used most recently.
+    TextBlock("y" * 10).OptLayout(None, options)
+    assert list(_TEXT_COSTS)[-1] == (options.Fingerprint(), 10)
+
+
+def test_fingerprints_are_released():
+    def lines(rows):
+        return rows
+
+    options = Options(margin_1=37, break_element_lines=lines)
+    assert Options(margin_1=37, break_element_lines=lines).Fingerprint() is (
+        options.Fingerprint()
+    )
+    assert options.Fingerprint() is not Options(margin_1=38).Fingerprint()
+    ref = weakref.ref(lines)
+    del options, lines
+    gc.collect()
+    assert ref() is None
+
+
+def test_layout_cache_eviction():
+    options = Options(layout_cache_size=1)
+    block = TextBlock("hello")
+    continuations = [TextBlock(s).OptLayout(None, options) for s in "ab"]
+    cache_stats.Reset()
+    for rest in continuations + continuations[-1:]:
+        block.OptLayout(rest, options)
+    assert len(block.layout_cache) == 1
+    assert (cache_stats.hits, cache_stats.misses, cache_stats.evictions) == (1, 2, 1)
+
+
+def test_clear_cache_after_render():
+    block = _wrap_or_stack()
+    expected = block.Render(Options())
+    assert len(block.layout_cache)
+    assert block.Render(Options(clear_cache_after_render=True)) == expected
+    assert not len(block.layout_cache)
+    assert not len(block.elements[0].elements[0].layout_cache)
+
+
+def test_blocks_are_compact():
+    block = _call("f", TextBlock("x"))
+    joined = JoinedLineBlock([TextBlock("a"), TextBlock("b")])
+    blocks = [block, joined, _wrap_or_stack(), VerbBlock(["a", "b"])]
+    assert not any(hasattr(b, "__dict__") for b in blocks + block.Children())
+    # Layouts are memoised inline until a block is laid out a second way.
+    text = block.elements[0]
+    assert text._cache is None
+    block.Render(OPTS)
+    assert isinstance(text._cache, tuple)
+    rest = TextBlock("x").OptLayout(None, OPTS)
+    text.OptLayout(rest, OPTS)
+    assert len(text.layout_cache) == 2
+    copies = [pickle.loads(pickle.dumps(b)) for b in blocks]
+    for b, c in zip(blocks, copies):
+        assert c._cache is None and c.Render(OPTS) == b.Render(OPTS)
+    assert copies[0].elements[0].Parents() == [copies[0]]
+
+
+def _call(name, *args):
+    return LineBlock([TextBlock(name), TextBlock("("), *args, TextBlock(")")])
+
+
+def test_interning_shares_equal_subtrees():
+    interner = BlockInterner()
+    first = interner.Intern(StackBlock([_call("f", _call("g")), _call("g")]))
+    assert first.elements[0].elements[2] is first.elements[1]
+    second = interner.Intern(StackBlock([_call("h"), _call("g")]))
+    assert second.elements[1] is first.elements[1]
+    assert second.elements[0] is not first.elements[0]
+    assert interner.Intern(_call("g")) is first.elements[1]
+    assert first.Render(OPTS) == "f(g())\ng()"
+    assert second.Render(OPTS) == "h()\ng()"
+
+
+def test_interning_keeps_distinct_blocks():
+    interner = BlockInterner()
+    block = interner.Intern(
+        StackBlock(
+            [
+                TextBlock("a"),
+                TextBlock("a", is_breaking=True),
+                StackBlock([TextBlock("a")], break_mult=2),
+                StackBlock([TextBlock("a")]),
+                JoinedLineBlock([TextBlock("a")]),
+                JoinedLineBlock([TextBlock("a")]),
+            ]
+        )
+    )
+    elements = block.elements
+    assert len(set(map(id, elements))) == len(elements)
+    assert elements[2].elements[0] is elements[0]
+    assert elements[4].elements[0] is elements[0]
+
+
+def test_equal_solutions_are_interned():
+    first = LineBlock([TextBlock("a"), TextBlock(", ")]).OptLayout(None, OPTS)
+    second = LineBlock([TextBlock("a"), TextBlock(", ")]).OptLayout(None, OPTS)
+    assert first is second
+    block = TextBlock("b")
+    block.OptLayout(first, OPTS)
+    cache_stats.Reset()
+    block.OptLayout(
+        TextBlock("a").OptLayout(TextBlock(", ").OptLayout(None, OPTS), OPTS), OPTS
+    )
+    assert cache_stats.hits == 1
+    narrow = Options(margin_1=10)
+    assert TextBlock("a").OptLayout(None, narrow) is not TextBlock("a").OptLayout(
+        None, OPTS
+    )
+
+
+def test_buffered_console_matches_console():
+    block = StackBlock(
+        [
+            _wrap_or_stack(),
+            LineBlock([TextBlock("  "), _call("f", _call("g"), TextBlock(", x"))]),
+            VerbBlock(["verbatim", "  text"], first_nl=True),
+        ]
+    )
+    layout = block.OptLayout(None, Options(margin_1=30)).layouts[0]
+    expected, output = io.StringIO(), io.StringIO()
+    support.Console(expected, 0, 30).PrintLayout(layout)
+    support.BufferedConsole(output, 0, 30).PrintLayout(layout)
+    assert output.getvalue() == expected.getvalue()
+
+
+def test_render_long_line():
+    block = LineBlock([TextBlock("x") for _ in range(5000)])
+    assert block.Render(Options(margin_1=10000)) == "x" * 5000
+
+
+def test_layout_composition():
+    a = support.Layout([support.LayoutElement.String("a")])
+    b = support.Layout([support.LayoutElement.NewLineSpace(2), (support.STRING, "b")])
+    assert str(a + b) == "a<NLi><spc(2)>b"
+    assert str(support.Layout.Stack([a, b, a])) == "a<NLi><NLi><spc(2)>b<NLi>a"
+    nested = support.Layout.Beside(a, support.Layout.Stack([a, b]))
+    output = io.StringIO()
+    support.BufferedConsole(output, 0, 80).PrintLayout(nested)
+    assert output.getvalue() == "aa\n \n   b"
+
+
+def test_lazy_layouts():
+    def make():
+        return StackBlock(
+            [
+                _wrap_or_stack(),
+                _call("f", ChoiceBlock([_call("g"), _call("h", TextBlock("x"))])),
+            ]
+        )
+
+    eager = make().OptLayout(None, Options(margin_1=30))
+    lazy = make().OptLayout(None, Options(margin_1=30, lazy_layouts=True))
+    assert repr(lazy) == repr(eager)
+    assert make().Render(Options(lazy_layouts=True)) == make().Render(OPTS)
+
+
+@pytest.mark.parametrize("prefix", [None, "# "])
+def test_prune_wraps(prefix):
+    def make():
+        items = [TextBlock("x" * (1 + i % 7)) for i in range(40)]
+        items[25] = ChoiceBlock([_call("f", TextBlock("y")), StackBlock(items[:3])])
+        return WrapBlock(items, sep=", ", prefix=prefix)
+
+    options = Options(margin_0=10, margin_1=30)
+    expected = make().OptLayout(None, options)
+    pruned = make().OptLayout(None, dataclasses.replace(options, prune_wraps=True))
+    # Pruning is exact, even for blocks starting past margin_1 - len(prefix).
+    for m in range(0, 100, 3):
+        expected.MoveToMargin(m)
+        pruned.MoveToMargin(m)
+        assert pruned.CurValueAt(m) == pytest.approx(expected.CurValueAt(m))
+        assert str(pruned.CurLayout()) == str(expected.CurLayout())
+
+
+@pytest.mark.parametrize("indent", [0, 15, 85])
+def test_prune_wraps_nested(indent):
+    def make():
+        inner = WrapBlock([TextBlock("aaa")] * 12, sep=", ")
+        outer = WrapBlock([inner, TextBlock("b" * 7), inner], sep=", ", prefix="- ")
+        return StackBlock(
+            [
+                LineBlock([TextBlock("p" * indent), inner]),
+                LineBlock([TextBlock("p" * indent), outer]),
+            ]
+        )
+
+    options = Options(margin_1=20)
+    pruned = dataclasses.replace(options, prune_wraps=True)
+    expected = make().OptLayout(None, options)
+    soln = make().OptLayout(None, pruned)
+    expected.MoveToMargin(0)
+    soln.MoveToMargin(0)
+    assert soln.CurValueAt(0) == pytest.approx(expected.CurValueAt(0))
+    assert str(soln.CurLayout()) == str(expected.CurLayout())
+
+
+def test_profiler():
+    text = TextBlock("abc")
+    block = ChoiceBlock([LineBlock([text, text]), StackBlock([text, text])])
+    opt_layout = LayoutBlock.OptLayout
+    with Profiler() as profiler:
+        block.Render(OPTS)
+        block.Render(OPTS)
+    assert LayoutBlock.OptLayout is opt_layout
+    assert profiler.by_class["ChoiceBlock"].calls == 2
+    assert profiler.by_class["ChoiceBlock"].cache_hits == 1
+    assert profiler.by_class["TextBlock"].calls == 4
+    assert profiler.by_class["MinSolution"].knots_out > 0
+    assert "ChoiceBlock" in profiler.Table()
+    assert len(profiler.Table(by_instance=True, limit=2).splitlines()) == 3
+    collapsed = io.StringIO()
+    profiler.WriteCollapsed(collapsed)
+    stacks = dict(line.rsplit(" ", 1) for line in collapsed.getvalue().splitlines())
+    assert "ChoiceBlock;LineBlock;TextBlock" in stacks
+    assert "ChoiceBlock;MinSolution" in stacks
+
+
+def test_deeply_nested_blocks():
+    # Deeper than the default recursion limit.
+    block = TextBlock("x")
+    for i in range(3000):
+        block = LineBlock([block]) if i % 2 else StackBlock([TextBlock("y"), block])
+    assert block.Render(OPTS) == "y\n" * 1500 + "x"
+
+
+def test_layout_steps_and_do_opt_layout_agree():
+    block = _call("f", _wrap_or_stack(), ChoiceBlock([_call("g"), _call("h")]))
+    assert repr(block.DoOptLayout(None, OPTS)) == repr(block.OptLayout(None, OPTS))
+
+
+def test_block_without_layout():
+    class Unfinished(LayoutBlock):
+        pass
+
+    with pytest.raises(NotImplementedError):
+        Unfinished().Render(OPTS)
+
+
+def test_solve_in_parallel():
+    def statements():
+        return StackBlock(
+            _call("f%d" % i, ChoiceBlock([_call("g"), _call("h")])) for i in range(20)
+        )
+
+    expected = statements().Render(OPTS)
+    block = statements()
+    with ProcessPoolExecutor(2) as pool:
+        assert SeedLayouts(block, OPTS, pool, workers=2, min_task_size=1) == 19
+    key = (OPTS.Fingerprint(), None)
+    assert all(key in child.layout_cache for child in block.elements[:-1])
+    assert block.Render(OPTS) == expected
+    assert SolveInParallel(statements(), OPTS, workers=2).ContentKey() == (
+        block.OptLayout(None, OPTS).ContentKey()
+    )
+
+
+def test_format_many():
+    def documents():
+        for i in range(30):
+            # Every tenth document gets a chunk to itself.
+            yield _call("f%d" % i, *[TextBlock("x")] * (20 if i % 10 else 200))
+
+    expected = [block.Render(OPTS) for block in documents()]
+    with ProcessPoolExecutor(2) as pool:
+        formatted = FormatMany(documents(), OPTS, pool, workers=2, chunk_size=100)
+        assert list(formatted) == expected
+        assert list(FormatMany(documents(), OPTS, pool, workers=2)) == expected
+
+
+@pytest.mark.parametrize("options", [OPTS, Options(margin_1=30)])
+def test_iter_lines(options):
+    block = StackBlock(
+        [
+            _call("f", _wrap_or_stack()),
+            LineBlock([TextBlock("x = "), VerbBlock(["a", "b"], first_nl=True)]),
+            TextBlock("end", is_breaking=True),
+        ]
+    )
+    lines = block.IterLines(options)
+    assert next(lines).startswith("f(")
+    assert "\n".join(block.IterLines(options)) == block.Render(options)
+
+
+def test_replace_element():
+    def document(name):
+        return StackBlock(
+            [_call("f", _wrap_or_stack()), _call(name, TextBlock("x")), _call("h")]
+        )
+
+    block = document("g")
+    block.Render(OPTS)
+    edited = block.elements[1]
+    edited.ReplaceElement(0, TextBlock("long_name"))
+    assert not edited.layout_cache and not block.layout_cache
+    assert block.elements[0].layout_cache and block.elements[2].layout_cache
+    cache_stats.Reset()
+    assert block.Render(OPTS) == document("long_name").Render(OPTS)
+    assert cache_stats.hits >= 2
+
+    # Changing the last element changes whether its ancestors are breaking.
+    edited.ReplaceElement(3, TextBlock(")", is_breaking=True))
+    assert edited.is_breaking
+    block.ReplaceElement(2, edited)
+    assert block.is_breaking
+    assert block.Render(OPTS).endswith("long_name(x)")
+
+
+def test_replace_element_shared():
+    # The root contains the edited block both directly and through another,
+    # which must be updated first.
+    edited = LineBlock([TextBlock("a")])
+    root = LineBlock([edited, LineBlock([edited])])
+    edited.ReplaceElement(0, TextBlock("b", is_breaking=True))
+    assert root.is_breaking
+    assert root.LastLeaf() is edited.elements[0]
+    assert root.Render(OPTS) == "b\nb"
+
+
+def test_parents_of_shared_block():
+    comma = TextBlock(",")
+    rows = [LineBlock([TextBlock("x"), comma] * 50) for _ in range(50)]
+    for i, row in enumerate(rows):
+        row.ReplaceElement(1, comma)
+        row.ReplaceElement(3, TextBlock(str(i)))
+    assert len(comma._parents) == 50
+    assert comma.Parents() == rows
+    for row in rows[:10]:
+        for j in range(1, 100, 2):
+            row.ReplaceElement(j, TextBlock(";"))
+    assert comma.Parents() == rows[10:] and len(comma._parents) == 40
+
+
+def _random_block(rand, depth, extras=False):
+    if depth == 0 or rand.random() < 0.2:
+        return TextBlock("x" * rand.randint(0, 12), is_breaking=rand.random() < 0.05)
+    elements = [
+        _random_block(rand, depth - 1, extras) for _ in range(rand.randint(1, 4))
+    ]
+    alternatives = [
+        LineBlock(elements),
+        StackBlock(elements, break_mult=rand.choice([0.5, 1, 2])),
+        WrapBlock(elements, sep=", ", prefix=rand.choice([None, "-"])),
+    ]
+    if extras:
+        alternatives += [
+            JoinedLineBlock(elements),
+            _ConditionalJoinedLineBlock(elements + [TextBlock("(")]),
+            _JoinedStackBlock(elements, joiner=TextBlock(",")),
+            _WrapIfLongBlock(elements, wrap_len=2),
+        ]
+    return rand.choice(alternatives + [ChoiceBlock(alternatives)])
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize(
+    "options",
+    [Options(margin_0=10, margin_1=30), Options(margin_1=20, margin_1_cost=10)],
+)
+def test_prune_choices(seed, options):
+    expected = _random_block(random.Random(seed), 5).OptLayout(None, options)
+    pruned = dataclasses.replace(options, prune_choices=True)
+    soln = _random_block(random.Random(seed), 5).OptLayout(None, pruned)
+    for m in range(0, 100, 3):
+        expected.MoveToMargin(m)
+        soln.MoveToMargin(m)
+        assert soln.CurValueAt(m) == pytest.approx(expected.CurValueAt(m))
+        assert str(soln.CurLayout()) == str(expected.CurLayout())
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_lower_bounds_hold(seed):
+    options = Options(margin_0=10, margin_1=30)
+    stack = [_random_block(random.Random(seed), 5)]
+    while stack:
+        block = stack.pop()
+        stack.extend(block.Children())
+        bound = block.LowerBound(options)
+        soln = block.OptLayout(None, options)
+        for m in range(0, 100, 3):
+            soln.MoveToMargin(m)
+            value = _BoundValueAt(bound, m, options)
+            assert soln.CurValueAt(m) >= value - 1e-9
+
+
+def test_prune_choices_keeps_lines_costed_once():
+    # Only the end of each line is costed, so the bound on the line of x's is
+    # that of a single string 50 wide, which doesn't rule it out.
+    xs = LineBlock([TextBlock("xxxxx")] * 10)
+    ys = StackBlock([TextBlock("y")] * 3, break_mult=0)
+    block = LineBlock([TextBlock("p" * 30), ChoiceBlock([ys, xs])])
+    assert block.Render(Options(prune_choices=True)) == "p" * 30 + "x" * 50
+    assert block.Render(Options(prune_choices=True)) == block.Render(OPTS)
+
+
+def test_prune_choices_skips_dominated_alternatives():
+    text = TextBlock("abc")
+    stack = StackBlock([TextBlock("abc"), TextBlock("def")])
+    block = ChoiceBlock([stack, text])
+    options = Options(prune_choices=True)
+    assert block.Render(options) == "abc"
+    assert not stack.layout_cache and text.layout_cache
+
+
+@pytest.mark.parametrize("max_knots", [2, 3, 5])
+def test_max_knots(max_knots):
+    options = Options(margin_0=10, margin_1=30)
+    exact = _random_block(random.Random(0), 5).Render(options)
+    block = _random_block(random.Random(0), 5)
+    capped = dataclasses.replace(options, max_knots=max_knots)
+    # The text is the same, though it may be laid out differently.
+    assert block.Render(capped).count("x") == exact.count("x")
+    stack = [block]
+    while stack:
+        node = stack.pop()
+        for soln in node.layout_cache.Solutions():
+            # TextBlock Solutions aren't built by the combinators.
+            assert len(soln.knots) <= max(max_knots, 3)
+        stack.extend(node.Children())
+
+
+def _count_knots(block):
+    knots = 0
+    stack = [block]
+    while stack:
+        node = stack.pop()
+        knots += sum(len(s.knots) for s in node.layout_cache.Solutions())
+        stack.extend(node.Children())
+    return knots
+
+
+def test_knot_tolerance():
+    options = Options(margin_0=10, margin_1=30)
+    approximate = dataclasses.replace(options, knot_tolerance=1)
+    exact_block = _random_block(random.Random(3), 5)
+    exact = exact_block.OptLayout(None, options)
+    block = _random_block(random.Random(3), 5)
+    soln = block.OptLayout(None, approximate)
+    assert _count_knots(block) < _count_knots(exact_block)
+    for m in range(0, 60):
+        exact.MoveToMargin(m)
+        soln.MoveToMargin(m)
+        # Approximate costs are upper bounds.
+        assert exact.CurValueAt(m) <= soln.CurValueAt(m) <= exact.CurValueAt(m) * 1.05
+
+
+@pytest.mark.parametrize("extras", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_restrict_margins(seed, extras):
+    options = Options(margin_0=10, margin_1=30)
+    expected_block = _random_block(random.Random(seed), 5, extras)
+    expected = expected_block.OptLayout(None, options)
+    block = _random_block(random.Random(seed), 5, extras)
+    restricted = dataclasses.replace(options, restrict_margins=True)
+    assert block.Render(restricted) == expected_block.Render(options)
+    # Laying the block out for every margin extends the ranges.
+    soln = block.OptLayout(None, restricted)
+    for m in range(0, 60, 3):
+        expected.MoveToMargin(m)
+        soln.MoveToMargin(m)
+        assert soln.CurValueAt(m) == pytest.approx(expected.CurValueAt(m))
+        assert str(soln.CurLayout()) == str(expected.CurLayout())
+
+
+def test_restrict_margins_ranges():
+    wrap = WrapBlock([TextBlock("ab"), TextBlock("cde")], prefix="-")
+    line = LineBlock([TextBlock("x" * 40), wrap])
+    options = Options(restrict_margins=True)
+    line.Render(options)
+    assert wrap.MarginRange(options) == (40, 40)
+    assert [e.MarginRange(options) for e in wrap.elements] == [(41, 41), (41, 44)]
+    # Only the margins in range have knots.
+    (soln,) = wrap.layout_cache.Solutions()
+    assert set(soln.knots) <= {0, 40}
+
+
+def test_restrict_margins_lowered():
+    # The tree which the _WrapIfLongBlock is laid out as takes its range.
+    wrap = _WrapIfLongBlock([TextBlock("xxxxx"), TextBlock("x")], wrap_len=2)
+    block = LineBlock([wrap, TextBlock(".")])
+    options = Options(margin_0=10, margin_1=30, restrict_margins=True)
+    assert block.Render(options) == "xxxxx x."
+    assert wrap.Lowered().MarginRange(options) == wrap.MarginRange(options) == (0, 0)
+
+
+def test_dump_and_load(tmp_path):
+    args = [TextBlock("é"), TextBlock("b", is_breaking=True), TextBlock("c")]
+    shared = _call("g", *args)
+    block = StackBlock(
+        [
+            ChoiceBlock([WrapBlock(args, sep=", ", prefix="# "), StackBlock(args)]),
+            JoinedLineBlock([shared, shared], joiner=TextBlock("+")),
+            JoinedLineBlock(args, joiner="-", join_breaking=True),
+            _ConditionalJoinedLineBlock([shared, TextBlock("."), TextBlock("y")]),
+            _ConditionalJoinedLineBlock(args, no_space_left="b", no_space_right={""}),
+            _JoinedStackBlock(args, joiner=";", break_mult=0.5),
+            _WrapIfLongBlock(args, prefix="-", wrap_len=2, break_mult=2),
+            VerbBlock(["x", "y"], first_nl=True),
+        ],
+        break_mult=1.5,
+    )
+    data = dump(block)
+    loaded = load(data)
+    assert repr(loaded) == repr(block)
+    assert loaded.Render(OPTS) == block.Render(OPTS)
+    # Shared blocks are stored once, and shared again.
+    assert loaded.elements[1].elements[0] is loaded.elements[3].elements[0]
+    assert len(data) < len(pickle.dumps(block))
+    path = tmp_path / "tree"
+    path.write_bytes(data)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        assert load(m).Render(OPTS) == block.Render(OPTS)
+    # Deeper than the default recursion limit.
+    deep = TextBlock("x")
+    for _ in range(3000):
+        deep = LineBlock([TextBlock("y"), deep])
+    assert load(dump(deep)).Render(OPTS) == "y" * 3000 + "x"
+
+
+def test_load_rejects_invalid_data():
+    class Block(TextBlock):
+        pass
+
+    with pytest.raises(TypeError):
+        dump(LineBlock([Block("x")]))
+    data = dump(_call("f", TextBlock("x")))
+    for invalid in [b"", b"PKL" + data[3:], data[:-1], data[:40], data + b"x"]:
+        with pytest.raises(ValueError):
+            load(invalid)